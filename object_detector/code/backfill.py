@@ -0,0 +1,114 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+"""
+ Parallel backfill of a recorded video: the file is split in time segments that are
+ processed by a pool of workers, each one with its own Detector, and the detection
+ events are sent in order, dated with the frame timestamps.
+"""
+
+import argparse
+import multiprocessing as mp
+import logging as log
+import sys
+
+from defaults import DEFAULT_SERVER, DEFAULT_PORT, DEFAULT_TABLE_NAME, DEFAULT_STAT_TABLE_NAME, \
+    DEFAULT_INFO_TABLE_NAME, DEFAULT_SOURCE, date_arg, load_labels_map
+from log_sender import Log
+from utils.autotune import worker_config
+from utils.network_wrappers import Detector
+from utils.segments import recording_info, split_segments, read_segment
+
+log.basicConfig(stream=sys.stdout, level=log.DEBUG)
+
+worker = {}
+
+
+def init_worker(params):
+    logger = Log(params.tdetect, params.tstat, params.tinfo, params.source, False, params.devo_server, params.devo_port)
+    # every worker gets its share of the cores instead of one inference thread per core each
+    worker['detector'] = Detector(logger, params.model, params.t_detector, params.device, params.cpu_extension,
+                                  nms_iou=params.nms_iou, cross_class_iou=params.cross_class_iou,
+                                  config=worker_config(params.device, params.workers))
+    worker['frame_step'] = params.frame_step
+
+
+def process_segment(segment):
+    """Returns (position, frame shape, detections) for the processed frames of a segment"""
+    path, start, end = segment
+    results = []
+    for position, frame in read_segment(path, start, end, worker['frame_step']):
+        detections = worker['detector'].get_detections([frame])[0]
+        results.append((position, frame.shape, detections))
+    return results
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Object Detector parallel backfill of a recorded video')
+    parser.add_argument('-i', type=str, help='Path to the video file', required=True)
+    parser.add_argument('-m', '--model', type=str, help='Path to the person detection model')
+    parser.add_argument('--t_detector', type=float, default=0.6, help='Threshold for the person detection model')
+    parser.add_argument('-d', '--device', type=str, default='CPU')
+    parser.add_argument("-l", "--cpu_extension",
+                        help="Optional. Required for CPU custom layers. "
+                             "Absolute path to a shared library with the kernels implementations inside the docker",
+                        type=str,
+                        default='/root/inference_engine_samples_build/intel64/Release/lib/libcpu_extension.so')
+    parser.add_argument("--nms_iou", help='IoU threshold removing overlapping detections of the same class '
+                                          '(1 keeps them all)', default=0.5, type=float)
+    parser.add_argument("--cross_class_iou", help='IoU threshold removing overlapping detections of different '
+                                                  'classes, keeping the most confident one (default: disabled)',
+                        type=float)
+    parser.add_argument('-w', '--workers', help='Number of worker processes', default=mp.cpu_count(), type=int)
+    parser.add_argument('--segment_length', help='Segment length (in seconds)', default=600, type=float)
+    parser.add_argument('--frame_step', help='Process one frame out of frame_step', default=1, type=int)
+    parser.add_argument("--replay_start", help='Recording start date (YYYY/MM/DD HH:MM:SS). '
+                                               'Default: file modification time minus its duration',
+                        type=date_arg)
+    parser.add_argument('-dt', '--tdetect', help='Object Detected Table Name.', default=DEFAULT_TABLE_NAME, type=str)
+    parser.add_argument('-st', '--tstat', help='Stats Table Name.', default=DEFAULT_STAT_TABLE_NAME, type=str)
+    parser.add_argument('-it', '--tinfo', help='Info Table Name.', default=DEFAULT_INFO_TABLE_NAME, type=str)
+    parser.add_argument('-ds', '--devo_server', help='Devo Server.', default=DEFAULT_SERVER, type=str)
+    parser.add_argument('-dp', '--devo_port', help='Devo Port.', default=DEFAULT_PORT, type=str)
+    parser.add_argument('-log', "--sendlogs", help='Send Logs to Devo Platform', action="store_true")
+    parser.add_argument('-s', "--source", help='Stream source identifier', type=str, default=DEFAULT_SOURCE)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = getArgs()
+    logger = Log(args.tdetect, args.tstat, args.tinfo, args.source, args.sendlogs, args.devo_server, args.devo_port)
+    labels_map = load_labels_map(args.model)
+
+    duration, recording_start = recording_info(args.i)
+    start = (args.replay_start if args.replay_start is not None else recording_start) * 1000
+    segments = split_segments(args.i, duration, args.segment_length * 1000)
+    logger.info("INFO", "Backfilling %s: %d segments on %d workers" % (args.i, len(segments), args.workers))
+
+    num_events = 0
+    pool = mp.Pool(args.workers, initializer=init_worker, initargs=(args,))
+    # imap keeps the segment order, so the merged stream is ordered by frame timestamp
+    for i, results in enumerate(pool.imap(process_segment, segments)):
+        for position, shape, detections in results:
+            logger.detection_events([shape], [detections], labels_map, [start + position])
+            num_events += len(detections)
+        logger.info("INFO", "Segment %d/%d done" % (i + 1, len(segments)))
+    pool.close()
+    pool.join()
+    logger.info("INFO", "Backfill finished: %d detection events" % num_events)
+
+
+if __name__ == '__main__':
+    main()
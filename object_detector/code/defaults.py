@@ -0,0 +1,38 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissi#ons and
+ limitations under the License.
+"""
+
+"""
+ Defaults and argument helpers shared by the live script and the backfill
+"""
+
+import os
+import time
+
+DEFAULT_SERVER = "eu.elb.relay.logtrust.net"
+DEFAULT_PORT = 443
+DEFAULT_TABLE_NAME = 'my.app.object_detector.objects'
+DEFAULT_STAT_TABLE_NAME = 'my.app.object_detector.stats'
+DEFAULT_INFO_TABLE_NAME = 'my.app.object_detector.info'
+DEFAULT_SOURCE = "unknown"
+
+
+def date_arg(value):
+    return time.mktime(time.strptime(value, "%Y/%m/%d %H:%M:%S"))
+
+
+def load_labels_map(model_id):
+    model_path = "models/" + model_id + "/" + model_id
+    model_labels = os.path.splitext(model_path) [0] + ".txt"
+    with open(model_labels, 'r') as f:
+        labels_map = [x.strip().upper() for x in f]
+    return labels_map
@@ -32,8 +32,14 @@ class Log:
                                             chain=CHAIN)
         return Sender(engine_config)
 
-    def detections(self, frames, detections, labels_map):
-        self._log_detection(self.tdetection, frames, detections, labels_map)
+    def detections(self, frames, detections, labels_map, timestamps=None, model=None):
+        """Logs the detections of every frame, tagged with the model name when given"""
+        shapes = [frame.shape if frame is not None else None for frame in frames]
+        self._log_detection(self.tdetection, shapes, detections, labels_map, timestamps, model)
+
+    def detection_events(self, shapes, detections, labels_map, timestamps):
+        """Logs detections computed elsewhere (e.g. backfill workers) from the frame shapes only"""
+        self._log_detection(self.tdetection, shapes, detections, labels_map, timestamps)
 
     def stats(self, stats):
         self._log_stat(self.tstat, stats)
@@ -86,27 +92,36 @@ class Log:
         encodedStr = str(jpg_as_text, "utf-8")
         return 'jpg;base64; ' + encodedStr
 
-    def __log_detections(self, table, cam, frame, detections, dateTimeObj, labels_map):
+    def __log_detections(self, table, cam, shape, detections, dateTimeObj, labels_map, model=None):
         """Draws detections and labels"""
-        msg = "cam_" + str(cam) + "|" + str(frame.shape[0]) + "|" + str(frame.shape[1]) + "|" + self.source \
+        msg = "cam_" + str(cam) + "|" + str(shape[0]) + "|" + str(shape[1]) + "|" + self.source \
             + "|" + dateTimeObj.strftime("%Y/%m/%d %H:%M:%S")
 
         for i, obj in enumerate(detections):
-            msg1 = self._build_msg(msg, obj, labels_map, frame)
+            msg1 = self._build_msg(msg, obj, labels_map, None)
+            if model is not None:
+                msg1 += '|' + model
             self._sendMsg(table, msg1)
 
-    def _log_detection(self, table,  frames, all_objects, labels_map):
-        assert len(frames) == len(all_objects)
+    def _log_detection(self, table,  shapes, all_objects, labels_map, timestamps=None, model=None):
+        assert len(shapes) == len(all_objects)
         cam=0
         dateTimeObj = datetime.datetime.now()
-        for frame, objects in zip(frames, all_objects):
-            self.__log_detections(table, cam, frame, objects, dateTimeObj, labels_map)
+        for shape, objects in zip(shapes, all_objects):
+            if shape is not None:
+                if timestamps is not None:
+                    # replayed recordings are dated with the frame timestamps (ms)
+                    dateTimeObj = datetime.datetime.fromtimestamp(timestamps[cam] / 1000.)
+                self.__log_detections(table, cam, shape, objects, dateTimeObj, labels_map, model)
             cam=cam+1
 
     def _log_stat(self, table, stats):
         msg_stat = self.source + "|" + str((stats['cap.end'] - stats['cap.start']) * 1000) \
                    + "|" + str((stats['inference.end'] - stats['inference.start']) * 1000) \
-                   + "|" + str((stats['end'] - stats['start']) * 1000)
+                   + "|" + str((stats['end'] - stats['start']) * 1000) \
+                   + "|" + str(stats.get('frames.dropped', 0)) \
+                   + "|" + str(stats.get('cache.hits', 0)) + "|" + str(stats.get('cache.misses', 0)) \
+                   + "|" + str(stats.get('motion.skipped', 0)) + "|" + str(stats.get('frames.skipped', 0))
         self._sendMsg(table, msg_stat)
 
     def _log_info(self, table, type, msg):
@@ -0,0 +1,130 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import itertools
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+
+def hardware_fingerprint():
+    """CPU model and core count: container hostnames change on every run, the hardware does not"""
+    cpu_model = 'unknown'
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu_model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return '%s x%d' % (cpu_model, os.cpu_count() or 1)
+
+
+def _tuning_key(model_id, device):
+    return '%s|%s|%s' % (hardware_fingerprint(), device, model_id)
+
+
+def load_tuning(tuning_file, model_id, device):
+    """Returns the tuned settings of a model on this hardware, None if it was never tuned"""
+    if not tuning_file or not os.path.isfile(tuning_file):
+        return None
+    with open(tuning_file) as f:
+        return json.load(f).get(_tuning_key(model_id, device))
+
+
+def save_tuning(tuning_file, model_id, device, tuning):
+    tunings = {}
+    if os.path.isfile(tuning_file):
+        with open(tuning_file) as f:
+            tunings = json.load(f)
+    tunings[_tuning_key(model_id, device)] = tuning
+    with open(tuning_file + '.tmp', 'w') as f:
+        json.dump(tunings, f, indent=2, sort_keys=True)
+    os.replace(tuning_file + '.tmp', tuning_file)
+
+
+def candidate_settings(device, max_batch=1):
+    """Yields (plugin config, number of infer requests, batch size) candidates"""
+    batch_sizes = sorted({1, max_batch})
+    if 'CPU' not in device:
+        for num_reqs, batch_size in itertools.product((1, 2, 4), batch_sizes):
+            yield {}, num_reqs, batch_size
+        return
+
+    cores = os.cpu_count() or 1
+    streams = sorted({s for s in (1, 2, 4, cores // 2, cores) if 1 <= s <= cores})
+    for num_streams, threads, batch_size in itertools.product(streams, (0, cores), batch_sizes):
+        config = {'CPU_THROUGHPUT_STREAMS': str(num_streams)}
+        if threads:
+            config['CPU_THREADS_NUM'] = str(threads)
+        for num_reqs in sorted({num_streams, 2 * num_streams}):
+            yield config, num_reqs, batch_size
+
+
+def worker_config(device, num_workers):
+    """CPU plugin config giving each one of num_workers processes its share of the cores"""
+    if 'CPU' not in device:
+        return {}
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    return {'CPU_THROUGHPUT_STREAMS': '1', 'CPU_THREADS_NUM': str(threads)}
+
+
+def benchmark(model, num_reqs, batch_size, duration=2.):
+    """Returns the throughput (images per second) of a model on synthetic input, keeping num_reqs requests busy"""
+    _, c, h, w = model.get_input_shape().shape
+    imgs = [np.random.randint(0, 256, (h, w, c), dtype=np.uint8)] * batch_size
+    # first inference pays the lazy initializations
+    model.forward_batch(imgs)
+
+    in_flight = deque()
+    num_images = 0
+    start = time.time()
+    while time.time() - start < duration:
+        if len(in_flight) == num_reqs:
+            model.collect(in_flight.popleft())
+            num_images += batch_size
+        in_flight.append(model.submit_batch(imgs))
+    while in_flight:
+        model.collect(in_flight.popleft())
+        num_images += batch_size
+    return num_images / (time.time() - start)
+
+
+def autotune(logger, model_id, device, cpu_extension, tuning_file, max_batch=1, duration=2.):
+    """Benchmarks a model across the candidate settings and stores the fastest one for this hardware"""
+    from utils.ie_tools import load_ie_model
+
+    best = None
+    for config, num_reqs, batch_size in candidate_settings(device, max_batch):
+        try:
+            model = load_ie_model(logger, model_id, device, None, cpu_extension, num_reqs=num_reqs,
+                                  batch_size=batch_size, config=config)
+            fps = benchmark(model, num_reqs, batch_size, duration)
+        except Exception as e:
+            logger.info("ERROR", "Autotune of %s failed with %s, %d requests, batch %d: %s" %
+                        (model_id, config, num_reqs, batch_size, e))
+            continue
+        logger.info("INFO", "Autotune %s: %s, %d requests, batch %d -> %.1f images/s" %
+                    (model_id, config, num_reqs, batch_size, fps))
+        if best is None or fps > best['fps']:
+            best = dict(config=config, num_reqs=num_reqs, batch_size=batch_size, fps=fps)
+        del model
+
+    if best is not None:
+        save_tuning(tuning_file, model_id, device, best)
+        logger.info("INFO", "Autotune %s: best %s" % (model_id, best))
+    return best
@@ -13,44 +13,102 @@
 
 import sys
 import os
+import hashlib
+import json
+import time
+from collections import deque, namedtuple
+from functools import partial
 
 import numpy as np
 from openvino.inference_engine import IENetwork, IECore # pylint: disable=import-error,E0611
 import cv2 as cv
 
+from utils.autotune import load_tuning
+
 
 class IEModel:
-    """Class for inference of models in the Inference Engine format"""
+    """Class for inference of models in the Inference Engine format
+
+    Requests are handed out from a pool of free infer requests: submit() starts
+    one and returns its id, collect() waits for it and gives it back to the pool,
+    so several inferences can be in flight while the caller keeps working.
+
+    Images are resized into a persistent buffer, or by a ResizeCache shared with
+    other models, and written straight into the input blob of the request. Outputs are read-only views of the output blob,
+    valid until the request is submitted again: copy them to keep them longer.
+    """
     def __init__(self, logger, exec_net, inputs_info, input_key, output_key):
         self.net = exec_net
         self.inputs_info = inputs_info
         self.input_key = input_key
         self.output_key = output_key
         self.reqs_ids = []
+        self.free_reqs = deque(range(len(exec_net.requests)))
+        _, c, h, w = self.get_input_shape().shape
+        self.resized = np.empty((h, w, c), dtype=np.uint8)
+        self.resize_cache = None
         self.logger = logger
 
-    def _preprocess(self, img):
-        _, _, h, w = self.get_input_shape().shape
-        img = np.expand_dims(cv.resize(img, (w, h)).transpose(2, 0, 1), axis=0)
-        return img
+    def _fill_input(self, id, imgs):
+        blob = self.net.requests[id].inputs[self.input_key]
+        assert len(imgs) <= blob.shape[0]
+        _, _, h, w = blob.shape
+        for i, img in enumerate(imgs):
+            if self.resize_cache is not None:
+                resized = self.resize_cache.resize(img, w, h)
+            else:
+                resized = cv.resize(img, (w, h), dst=self.resized)
+            # HWC -> CHW conversion done by the copy into the blob memory
+            np.copyto(blob[i], resized.transpose(2, 0, 1))
+        # unused batch slots are left empty
+        blob[len(imgs):] = 0
+
+    def _start(self, imgs):
+        assert self.free_reqs, 'All the infer requests are in flight'
+        id = self.free_reqs.popleft()
+        self._fill_input(id, imgs)
+        self.net.requests[id].async_infer()
+        return id
+
+    def submit(self, img):
+        """Starts an asynchronous inference on an image, returns its request id"""
+        return self._start([img])
+
+    def submit_batch(self, imgs):
+        """Starts an asynchronous inference on a batch of images"""
+        return self._start(imgs)
+
+    def submit_tensor(self, tensor):
+        """Starts an asynchronous inference on an already resized (N, C, H, W) tensor"""
+        assert self.free_reqs, 'All the infer requests are in flight'
+        id = self.free_reqs.popleft()
+        blob = self.net.requests[id].inputs[self.input_key]
+        np.copyto(blob[:len(tensor)], tensor)
+        blob[len(tensor):] = 0
+        self.net.requests[id].async_infer()
+        return id
+
+    def collect(self, id):
+        """Waits for a submitted request and returns a read-only view of its output"""
+        self.net.requests[id].wait(-1)
+        res = self.net.requests[id].outputs[self.output_key].view()
+        res.flags.writeable = False
+        self.free_reqs.append(id)
+        return res
 
     def forward(self, img):
         """Performs forward pass of the wrapped IE model"""
-        res = self.net.infer(inputs={self.input_key: self._preprocess(img)})
-        return np.copy(res[self.output_key])
+        return self.collect(self.submit(img))
+
+    def forward_batch(self, imgs):
+        """Performs a single forward pass on a batch of images"""
+        return self.collect(self.submit_batch(imgs))
 
     def forward_async(self, img):
-        id = len(self.reqs_ids)
-        self.net.start_async(request_id=id,
-                             inputs={self.input_key: self._preprocess(img)})
-        self.reqs_ids.append(id)
+        self.reqs_ids.append(self.submit(img))
 
     def grab_all_async(self):
-        outputs = []
-        for id in self.reqs_ids:
-            self.net.requests[id].wait(-1)
-            res = self.net.requests[id].outputs[self.output_key]
-            outputs.append(np.copy(res))
+        outputs = [self.collect(id) for id in self.reqs_ids]
         self.reqs_ids = []
         return outputs
 
@@ -58,16 +116,143 @@ class IEModel:
         """Returns an input shape of the wrapped IE model"""
         return self.inputs_info[self.input_key]
 
-def load_ie_model(logger, model_id, device, plugin_dir, cpu_extension='', num_reqs=1):
-    """Loads a model in the Inference Engine format"""
+    def warmup(self, num_rounds):
+        """Runs num_rounds inferences on every infer request, on synthetic input
+
+        The first inferences of a request pay for its lazy initializations, a warmed
+        up model runs the first real frames at steady state speed.
+        """
+        if num_rounds <= 0:
+            return
+        start = time.time()
+        tensor = np.random.randint(0, 256, self.net.requests[0].inputs[self.input_key].shape, dtype=np.uint8)
+        for _ in range(num_rounds):
+            ids = [self.submit_tensor(tensor) for _ in range(len(self.free_reqs))]
+            for id in ids:
+                self.collect(id)
+        self.logger.info("INFO", "Warm-up: %d inferences on %d requests in %.2f s" %
+                         (num_rounds, len(self.net.requests), time.time() - start))
+
+
+class ResizeCache:
+    """Images resized once for all the models of a frame set sharing an input size
+
+    Entries are keyed by image identity: clear() it before every new frame set.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def clear(self):
+        self.entries.clear()
+
+    def resize(self, img, w, h):
+        key = (id(img), w, h)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] is not img:
+            # the image is kept in the entry so its id cannot be reused while cached
+            entry = (img, cv.resize(img, (w, h)))
+            self.entries[key] = entry
+        return entry[1]
+
+InputInfo = namedtuple('InputInfo', 'shape')
+
+_ie_cores = {}
+
+
+def _get_ie_core(logger, device, cpu_extension):
+    """Returns the IECore of the process, plugins and extensions are loaded only once"""
+    extension = cpu_extension if cpu_extension and 'CPU' in device else ''
+    if extension not in _ie_cores:
+        logger.info("INFO", "Creating Inference Engine")
+        ie = IECore()
+        if extension:
+            ie.add_extension(extension, 'CPU')
+        _ie_cores[extension] = ie
+    return _ie_cores[extension]
+
+
+_uncacheable_devices = set()
+
+
+def _disable_cache(logger, device, reason):
+    """Turns the compiled network cache off for a device, warning only once per process"""
+    if device not in _uncacheable_devices:
+        _uncacheable_devices.add(device)
+        logger.info("ERROR", "Compiled network cache disabled on %s: %s" % (device, reason))
+
+
+def _cache_path(cache_dir, model_xml, model_bin, device, config, batch_size):
+    """Cache entry of a compiled network, keyed by the IR content, the device and the load settings"""
+    sha = hashlib.sha1()
+    for path in (model_xml, model_bin):
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, 1 << 20), b''):
+                sha.update(chunk)
+    sha.update(json.dumps([device, config, batch_size], sort_keys=True).encode())
+    return os.path.join(cache_dir, sha.hexdigest())
+
+
+def _import_network(logger, ie, cache_path, device, config, num_reqs):
+    """Loads a compiled network from the cache, returns None on a cache miss"""
+    # the sidecar is written last, it marks a complete entry
+    if not os.path.isfile(cache_path + '.json'):
+        return None
+    try:
+        with open(cache_path + '.json') as f:
+            info = json.load(f)
+        exec_net = ie.import_network(model_file=cache_path + '.blob', device_name=device,
+                                     config=config, num_requests=num_reqs)
+    except Exception as e:
+        logger.info("ERROR", "Cannot import the cached network %s: %s" % (cache_path, e))
+        return None
+    logger.info("INFO", "Compiled network imported from " + cache_path)
+    inputs_info = {info['input_key']: InputInfo(tuple(info['input_shape']))}
+    return IEModel(logger, exec_net, inputs_info, info['input_key'], info['output_key'])
+
+
+def _export_network(logger, exec_net, device, cache_path, input_key, output_key, input_shape):
+    """Stores a compiled network in the cache when the plugin can export it"""
+    if not hasattr(exec_net, 'export'):
+        _disable_cache(logger, device, 'the Inference Engine cannot export networks')
+        return
+    try:
+        exec_net.export(cache_path + '.blob.tmp')
+        os.replace(cache_path + '.blob.tmp', cache_path + '.blob')
+        with open(cache_path + '.json.tmp', 'w') as f:
+            json.dump(dict(input_key=input_key, output_key=output_key, input_shape=list(input_shape)), f)
+        os.replace(cache_path + '.json.tmp', cache_path + '.json')
+    except Exception as e:
+        # not every plugin supports exporting its compiled networks
+        _disable_cache(logger, device, e)
+
+
+def load_ie_model(logger, model_id, device, plugin_dir, cpu_extension='', num_reqs=1, batch_size=1, config=None,
+                  cache_dir=None, tuning_file=None, warmup=0):
+    """Loads a model in the Inference Engine format, through the compiled network cache when cache_dir is set
+    and with the settings found by the autotune for this host when there are any.
+    Every infer request then runs warmup inferences on synthetic input"""
     model_path = "models/" + model_id + "/" + model_id
     model_xml = os.path.splitext(model_path)[0] + ".xml"
     model_bin = os.path.splitext(model_path)[0] + ".bin"
+    config = config or {}
+    tuning = load_tuning(tuning_file, model_id, device)
+    if tuning is not None:
+        # explicit settings take precedence over the tuned ones
+        config = dict(tuning['config'], **config)
+        num_reqs = max(num_reqs, tuning['num_reqs'])
     # Plugin initialization for specified device and load extensions library if specified
-    logger.info("INFO","Creating Inference Engine")
-    ie = IECore()
-    if cpu_extension and 'CPU' in device:
-        ie.add_extension(cpu_extension, 'CPU')
+    ie = _get_ie_core(logger, device, cpu_extension)
+    if cache_dir and not hasattr(ie, 'import_network'):
+        # import_network and ExecutableNetwork.export arrived after 2019 R3
+        _disable_cache(logger, device, 'the Inference Engine cannot import networks')
+    cache_path = None
+    if cache_dir and device not in _uncacheable_devices:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = _cache_path(cache_dir, model_xml, model_bin, device, config, batch_size)
+        model = _import_network(logger, ie, cache_path, device, config, num_reqs)
+        if model is not None:
+            model.warmup(warmup)
+            return model
     # Read IR
     logger.info("INFO", "Loading network files")
     net = IENetwork(model=model_xml, weights=model_bin)
@@ -90,10 +275,13 @@ def load_ie_model(logger, model_id, device, plugin_dir, cpu_extension='', num_re
     logger.info("INFO", "Preparing input blobs")
     input_blob = next(iter(net.inputs))
     out_blob = next(iter(net.outputs))
-    net.batch_size = 1
+    net.batch_size = batch_size
 
     # Loading model to the plugin
     logger.info("INFO", "Loading model to the plugin" + model_path)
-    exec_net = ie.load_network(network=net, device_name=device, num_requests=num_reqs)
+    exec_net = ie.load_network(network=net, device_name=device, config=config, num_requests=num_reqs)
+    if cache_path is not None:
+        _export_network(logger, exec_net, device, cache_path, input_blob, out_blob, net.inputs[input_blob].shape)
     model = IEModel(logger, exec_net, net.inputs, input_blob, out_blob)
+    model.warmup(warmup)
     return model
@@ -0,0 +1,91 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from collections import deque
+
+import numpy as np
+import cv2 as cv
+
+
+class MotionGate:
+    """Cheap change detector comparing a downscaled grayscale frame with the last inferred one"""
+
+    def __init__(self, sensitivity=0.005, pixel_threshold=25, max_skip=30, width=64):
+        self.sensitivity = sensitivity
+        self.pixel_threshold = pixel_threshold
+        self.max_skip = max_skip
+        self.width = width
+        self.reference = None
+        self.skipped = 0
+
+    def _thumbnail(self, frame):
+        height = max(1, frame.shape[0] * self.width // frame.shape[1])
+        small = cv.resize(frame, (self.width, height), interpolation=cv.INTER_AREA)
+        gray = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        return cv.GaussianBlur(gray, (5, 5), 0)
+
+    def has_motion(self, frame):
+        """Returns True if the frame has to go through the detector"""
+        thumbnail = self._thumbnail(frame)
+        if self.reference is None or self.reference.shape != thumbnail.shape or self.skipped >= self.max_skip:
+            changed = True
+        else:
+            diff = cv.absdiff(thumbnail, self.reference)
+            changed = np.count_nonzero(diff > self.pixel_threshold) > self.sensitivity * diff.size
+
+        if changed:
+            self.reference = thumbnail
+            self.skipped = 0
+        else:
+            self.skipped += 1
+        return changed
+
+
+class MotionGatedDetector:
+    """Wrapper running the detector only on cameras whose frame changed
+
+    Static cameras get the detections of their last inferred frame.
+    """
+
+    def __init__(self, detector, num_sources, sensitivity=0.005, max_skip=30):
+        self.detector = detector
+        self.gates = [MotionGate(sensitivity, max_skip=max_skip) for _ in range(num_sources)]
+        self.last_detections = [[] for _ in range(num_sources)]
+        self.pending = deque()
+        self.skipped = 0
+
+    def submit(self, frames):
+        """Starts the inference of the frames that changed"""
+        moving = [frame is not None and self.gates[i].has_motion(frame) for i, frame in enumerate(frames)]
+        self.detector.submit([frame if moving[i] else None for i, frame in enumerate(frames)])
+        self.pending.append((moving, [frame is None for frame in frames]))
+
+    def collect(self):
+        """Returns all detections of the oldest submitted frame set"""
+        moving, missing = self.pending.popleft()
+        detections = self.detector.collect()
+        for i, camera_detections in enumerate(detections):
+            if moving[i]:
+                self.last_detections[i] = camera_detections
+        self.skipped += len(moving) - sum(moving) - sum(missing)
+
+        all_detections = list(self.last_detections)
+        for i, is_missing in enumerate(missing):
+            if is_missing:
+                all_detections[i] = []
+        return all_detections
+
+    def get_detections(self, frames):
+        """Returns all detections on frames"""
+        self.submit(frames)
+        return self.collect()
@@ -0,0 +1,63 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from utils.ie_tools import ResizeCache
+
+
+class MultiModelDetector:
+    """Runs several detectors on the same frame sets
+
+    Every model is submitted before any of them is collected, so the requests of
+    all the models are in flight together. Local networks with the same input size
+    resize a frame only once.
+    """
+
+    def __init__(self, names):
+        self.names = names
+        self.detectors = []
+        self.resize_cache = None
+
+    def add(self, detector):
+        self.detectors.append(detector)
+
+    def share_resizes(self, nets):
+        """Makes the local networks sharing an input size use one ResizeCache
+
+        A lone network keeps resizing straight into its persistent buffer.
+        """
+        local = [net for net in nets if hasattr(net, 'resize_cache')]
+        sizes = [tuple(net.get_input_shape().shape[2:]) for net in local]
+        for net, size in zip(local, sizes):
+            if sizes.count(size) > 1:
+                if self.resize_cache is None:
+                    self.resize_cache = ResizeCache()
+                net.resize_cache = self.resize_cache
+
+    def submit(self, frames):
+        """Starts the inference of a frame set on every model"""
+        if self.resize_cache is not None:
+            self.resize_cache.clear()
+        for detector in self.detectors:
+            detector.submit(frames)
+        if self.resize_cache is not None:
+            # the resized frames are in the request blobs now
+            self.resize_cache.clear()
+
+    def collect(self):
+        """Returns the detections of the oldest submitted frame set, one list per model"""
+        return [detector.collect() for detector in self.detectors]
+
+    def get_detections(self, frames):
+        """Returns the detections on frames of every model"""
+        self.submit(frames)
+        return self.collect()
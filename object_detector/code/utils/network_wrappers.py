@@ -11,49 +11,175 @@
  limitations under the License.
 """
 
+from collections import deque
+
+import numpy as np
+
+from utils.autotune import load_tuning
 from utils.ie_tools import load_ie_model
+from utils.inference_server import RemoteIEModel
+from utils.nms import nms
 
 
 class Detector:
     """Wrapper class for detector"""
 
-    def __init__(self, logger, model_path, conf=.6, device='CPU', ext_path='', max_num_frames=1 ):
-        self.net = load_ie_model(logger, model_path, device, None, ext_path, num_reqs=max_num_frames)
+    def __init__(self, logger, model_path, conf=.6, device='CPU', ext_path='', max_num_frames=1, batch=False,
+                 pipeline_depth=1, cache_dir=None, server=None, tuning_file=None,
+                 tile_grid=None, tile_overlap=0.2, tile_regions=None, tile_nms=0.5,
+                 nms_iou=None, cross_class_iou=None, warmup=0, config=None):
+        tuning = load_tuning(tuning_file, model_path, device)
+        if tuning is not None and tuning['batch_size'] > 1:
+            # the autotune found batches faster on this host
+            batch = True
+        self.tile_grid = tile_grid
+        self.tile_overlap = tile_overlap
+        self.tile_regions = tile_regions or [(0., 0., 1., 1.)]
+        self.tile_nms = tile_nms
+        self.tile_rects = {}
+        if tile_grid:
+            # every frame runs as one batch: the whole frame followed by its tiles
+            self.num_tile_images = 1 + len(self.tile_regions) * tile_grid[0] * tile_grid[1]
+            self.net = load_ie_model(logger, model_path, device, None, ext_path,
+                                     num_reqs=max_num_frames * pipeline_depth, batch_size=self.num_tile_images,
+                                     cache_dir=cache_dir, warmup=warmup, config=config)
+            batch = False
+        elif server:
+            # the inference server batches the frames of all its clients
+            self.net = RemoteIEModel(logger, server, model_path)
+            batch = False
+        elif batch:
+            # a single request per frame set running all the frames as one batch
+            self.net = load_ie_model(logger, model_path, device, None, ext_path, num_reqs=pipeline_depth,
+                                     batch_size=max_num_frames, cache_dir=cache_dir, tuning_file=tuning_file,
+                                     warmup=warmup, config=config)
+        else:
+            self.net = load_ie_model(logger, model_path, device, None, ext_path,
+                                     num_reqs=max_num_frames * pipeline_depth, cache_dir=cache_dir,
+                                     tuning_file=tuning_file, warmup=warmup, config=config)
+        self.batch = batch
+        self.pending = deque()
         self.confidence = conf
+        self.nms_iou = nms_iou
+        self.cross_class_iou = cross_class_iou
         self.max_num_frames = max_num_frames
         self.logger = logger
 
-    def get_detections(self, frames):
-        """Returns all detections on frames"""
+    def submit(self, frames):
+        """Starts the inference of a frame set, its detections are returned by collect()"""
         assert len(frames) <= self.max_num_frames
 
-        all_detections = []
-        for i in range(len(frames)):
-            self.net.forward_async(frames[i])
-        outputs = self.net.grab_all_async()
+        valid_frames = [frame for frame in frames if frame is not None]
+        if self.batch:
+            reqs = [self.net.submit_batch(valid_frames)] if valid_frames else []
+        elif self.tile_grid:
+            reqs = [self.net.submit_batch(self._tile_images(frame)) for frame in valid_frames]
+        else:
+            reqs = [self.net.submit(frame) for frame in valid_frames]
+        self.pending.append(([None if frame is None else frame.shape for frame in frames], reqs))
+
+    def collect(self):
+        """Returns all detections of the oldest submitted frame set"""
+        shapes, reqs = self.pending.popleft()
+        if self.batch:
+            num_frames = sum(shape is not None for shape in shapes)
+            outputs = self._split_batch_output(self.net.collect(reqs[0]), num_frames) if reqs else []
+        elif self.tile_grid:
+            outputs = [self._split_batch_output(self.net.collect(id), self.num_tile_images) for id in reqs]
+        else:
+            outputs = [self.net.collect(id)[0, 0] for id in reqs]
+        outputs = iter(outputs)
 
-        for i, out in enumerate(outputs):
-            detections = self.__decode_detections(out, frames[i].shape)
+        all_detections = []
+        for shape in shapes:
+            if shape is None:
+                # camera missing from the frame set
+                all_detections.append([])
+                continue
+            if self.tile_grid:
+                detections = self.__decode_tiles(next(outputs), shape)
+            else:
+                detections = self.__decode_detections(next(outputs), shape)
             all_detections.append(detections)
 
         return all_detections
 
-    def __decode_detections(self, out, frame_shape):
-        """Decodes raw SSD output"""
-        detections = []
+    def get_detections(self, frames):
+        """Returns all detections on frames"""
+        self.submit(frames)
+        return self.collect()
+
+    @staticmethod
+    def _split_batch_output(out, num_frames):
+        """Splits the SSD output rows of a batch by their image id"""
+        out = out[0, 0]
+        end = np.flatnonzero(out[:, 0] < 0)
+        if len(end):
+            # rows after the first negative image id are not valid detections
+            out = out[:end[0]]
+        return [out[out[:, 0] == i] for i in range(num_frames)]
 
-        for detection in out[0, 0]:
-            confidence = detection[2]
-            if confidence > self.confidence:
-                left = int(max(detection[3], 0) * frame_shape[1])
-                top = int(max(detection[4], 0) * frame_shape[0])
-                right = int(max(detection[5], 0) * frame_shape[1])
-                bottom = int(max(detection[6], 0) * frame_shape[0])
-                class_id = int(max(detection[1], 0))
+    def _get_tile_rects(self, frame_shape):
+        """Returns the (left, top, right, bottom) overlapping tiles of the configured regions of a frame"""
+        if frame_shape not in self.tile_rects:
+            height, width = frame_shape[:2]
+            cols, rows = self.tile_grid
+            rects = []
+            for x0, y0, x1, y1 in self.tile_regions:
+                tile_w = (x1 - x0) * width / (cols - (cols - 1) * self.tile_overlap)
+                tile_h = (y1 - y0) * height / (rows - (rows - 1) * self.tile_overlap)
+                for row in range(rows):
+                    for col in range(cols):
+                        left = x0 * width + col * tile_w * (1 - self.tile_overlap)
+                        top = y0 * height + row * tile_h * (1 - self.tile_overlap)
+                        rects.append((int(left), int(top),
+                                      int(min(left + tile_w, width)), int(min(top + tile_h, height))))
+            self.tile_rects[frame_shape] = rects
+        return self.tile_rects[frame_shape]
 
-                detections.append(((left, top, right, bottom), confidence, class_id))
+    def _tile_images(self, frame):
+        tiles = [frame[top:bottom, left:right] for left, top, right, bottom in self._get_tile_rects(frame.shape)]
+        return [frame] + tiles
+
+    def decode_array(self, out, frame_shape):
+        """Returns the boxes (N x 4 ints), confidences and class ids of the SSD output rows
+        of one image above the threshold, sorted by decreasing confidence"""
+        out = out[out[:, 2] > self.confidence]
+        out = out[np.argsort(-out[:, 2], kind='stable')]
+        height, width = frame_shape[:2]
+        scale = np.array([width, height, width, height], dtype=out.dtype)
+        boxes = (np.clip(out[:, 3:7], 0, 1) * scale).astype(np.int32)
+        class_ids = np.maximum(out[:, 1], 0).astype(np.int32)
+        return boxes, out[:, 2], class_ids
+
+    def __decode_detections(self, out, frame_shape):
+        """Decodes raw SSD output rows of one image"""
+        boxes, confidences, class_ids = self._suppress_duplicates(*self.decode_array(out, frame_shape))
+        return list(zip(map(tuple, boxes.tolist()), confidences, class_ids.tolist()))
 
-        if len(detections) > 1:
-            detections.sort(key=lambda x: x[1], reverse=True)
+    def __decode_tiles(self, outputs, frame_shape):
+        """Decodes the outputs of a frame and its tiles, boxes found by several tiles are merged"""
+        height, width = frame_shape[:2]
+        rects = [(0, 0, width, height)] + self._get_tile_rects(frame_shape)
+        all_boxes, all_confidences, all_class_ids = [], [], []
+        for out, (left, top, right, bottom) in zip(outputs, rects):
+            boxes, confidences, class_ids = self.decode_array(out, (bottom - top, right - left))
+            all_boxes.append(boxes + np.array([left, top, left, top], dtype=np.int32))
+            all_confidences.append(confidences)
+            all_class_ids.append(class_ids)
+        boxes, confidences, class_ids = \
+            np.concatenate(all_boxes), np.concatenate(all_confidences), np.concatenate(all_class_ids)
+        keep = nms(boxes, confidences, self.tile_nms, class_ids)
+        boxes, confidences, class_ids = self._suppress_duplicates(boxes[keep], confidences[keep], class_ids[keep])
+        return list(zip(map(tuple, boxes.tolist()), confidences, class_ids.tolist()))
 
-        return detections
+    def _suppress_duplicates(self, boxes, confidences, class_ids):
+        """Removes overlapping boxes of the same class, then overlapping boxes of any class"""
+        if self.nms_iou is not None:
+            keep = nms(boxes, confidences, self.nms_iou, class_ids)
+            boxes, confidences, class_ids = boxes[keep], confidences[keep], class_ids[keep]
+        if self.cross_class_iou is not None:
+            # the same object reported under several classes keeps its most confident one
+            keep = nms(boxes, confidences, self.cross_class_iou)
+            boxes, confidences, class_ids = boxes[keep], confidences[keep], class_ids[keep]
+        return boxes, confidences, class_ids
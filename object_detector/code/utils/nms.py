@@ -0,0 +1,50 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import numpy as np
+
+
+def pairwise_iou(boxes1, boxes2):
+    """IoU matrix between (N, 4) and (M, 4) left, top, right, bottom boxes"""
+    left1, top1, right1, bottom1 = np.asarray(boxes1, dtype=np.float32).T
+    left2, top2, right2, bottom2 = np.asarray(boxes2, dtype=np.float32).T
+    area1 = np.clip(right1 - left1, 0, None) * np.clip(bottom1 - top1, 0, None)
+    area2 = np.clip(right2 - left2, 0, None) * np.clip(bottom2 - top2, 0, None)
+    width = np.minimum(right1[:, None], right2[None, :]) - np.maximum(left1[:, None], left2[None, :])
+    height = np.minimum(bottom1[:, None], bottom2[None, :]) - np.maximum(top1[:, None], top2[None, :])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    union = area1[:, None] + area2[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+def nms(boxes, scores, iou_thresh, class_ids=None):
+    """Greedy non maximum suppression of (N, 4) left, top, right, bottom boxes
+
+    Returns the indexes of the kept boxes by decreasing score. With class_ids,
+    only boxes of the same class suppress each other.
+    """
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    boxes = np.asarray(boxes)[order]
+    # overlaps[i, j]: box i suppresses box j when i is kept, only lower scored boxes are considered
+    overlaps = np.triu(pairwise_iou(boxes, boxes) > iou_thresh, k=1)
+    if class_ids is not None:
+        class_ids = np.asarray(class_ids)[order]
+        overlaps &= class_ids[:, None] == class_ids[None, :]
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in np.flatnonzero(overlaps.any(axis=1)):
+        if not suppressed[i]:
+            suppressed |= overlaps[i]
+    return order[~suppressed]
@@ -0,0 +1,59 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os
+
+import cv2 as cv
+
+
+def recording_info(path):
+    """Returns the duration (ms) of a recording and its estimated start (epoch seconds)"""
+    cap = cv.VideoCapture(path)
+    assert cap.isOpened(), 'Cannot open {}'.format(path)
+    fps = cap.get(cv.CAP_PROP_FPS)
+    num_frames = cap.get(cv.CAP_PROP_FRAME_COUNT)
+    cap.release()
+    assert fps > 0 and num_frames > 0, 'Cannot compute the duration of {}'.format(path)
+    duration = num_frames / fps * 1000
+    return duration, os.path.getmtime(path) - duration / 1000
+
+
+def split_segments(path, duration, segment_length):
+    """Splits [0, duration) ms into (path, start, end) segments of segment_length ms"""
+    segments = []
+    start = 0.
+    while start < duration:
+        segments.append((path, start, min(start + segment_length, duration)))
+        start += segment_length
+    return segments
+
+
+def read_segment(path, start, end, frame_step=1):
+    """Yields (position in ms, frame) for every frame_step-th frame of the [start, end) ms segment"""
+    cap = cv.VideoCapture(path)
+    cap.set(cv.CAP_PROP_POS_MSEC, start)
+    index = 0
+    while cap.grab():
+        position = cap.get(cv.CAP_PROP_POS_MSEC)
+        if position >= end:
+            break
+        if position < start:
+            # the seek landed on an earlier key frame, these frames belong to the previous segment
+            continue
+        if index % frame_step == 0:
+            has_frame, frame = cap.retrieve()
+            if not has_frame:
+                break
+            yield position, frame
+        index += 1
+    cap.release()
@@ -0,0 +1,232 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os
+import queue
+import signal
+import time
+import multiprocessing as mp
+from functools import partial
+
+import numpy as np
+
+from utils.streaming import MultiStreamerCapture
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+class SharedFrameRing:
+    """Ring of preallocated frame set slots living in a shared memory block"""
+
+    def __init__(self, shapes, num_slots, name=None, create=True):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.cumsum([0] + self.sizes)
+        self.num_slots = num_slots
+        slot_size = int(self.offsets[-1])
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=slot_size * num_slots)
+        self.name = self.shm.name
+        self.buffer = np.ndarray((num_slots, slot_size), dtype=np.uint8, buffer=self.shm.buf)
+
+    def get_frames(self, slot):
+        """Returns the frames stored in a slot as views into the shared memory block"""
+        return [self.buffer[slot, self.offsets[i]:self.offsets[i + 1]].reshape(shape)
+                for i, shape in enumerate(self.shapes)]
+
+    def close(self):
+        del self.buffer
+        try:
+            self.shm.close()
+        except BufferError:
+            # frame views are still referenced, the mapping goes away with the process
+            pass
+
+    def unlink(self):
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            # already removed by the other side
+            pass
+
+    @staticmethod
+    def unlink_stale(name):
+        """Removes a block left behind by a capture process that was killed"""
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return False
+        stale.close()
+        stale.unlink()
+        return True
+
+
+def ring_name(pid):
+    """Name of the shared block of a pipeline, stable across its restarts so a killed run's block can be found"""
+    return 'frame_ring_%d' % pid
+
+
+def _restart(logger, pid, parent_pid):
+    if os.getppid() != parent_pid:
+        # the inference process is gone, never signal the one that replaced it
+        os._exit(0)
+    logger.info("ERROR", "error in shared memory capture -> RESTARTING -> stoping %s..." % (pid))
+    os.kill(pid, signal.SIGUSR1)
+
+
+def _capture_process_body(logger, sources, capture_args, pid, parent_pid, num_slots, ready, free, dropped,
+                          models_ready=None):
+    """Capture process: decodes straight into free ring slots and publishes their indexes
+
+    With models_ready, frames are only published once that event is set.
+    """
+    from watchdog_timer import WDT
+
+    capture = MultiStreamerCapture(logger, sources, **capture_args)
+    # the first frame set sizes the ring before the consumer loads its models
+    capture.start()
+    has_frames, frames = capture.get_frames()
+    if not has_frames:
+        ready.put(None)
+        capture.release()
+        return
+
+    name = ring_name(pid)
+    if SharedFrameRing.unlink_stale(name):
+        # the previous run was terminated (watchdog restart) before it could unlink its block
+        logger.info("INFO", "Removed stale shared memory block " + name)
+    ring = SharedFrameRing([frame.shape for frame in frames], num_slots, name=name)
+    slot = free.get()
+    for view, frame in zip(ring.get_frames(slot), frames):
+        np.copyto(view, frame)
+    ready.put(('init', ring.name, ring.shapes))
+    if models_ready is None:
+        ready.put(('frames', slot, capture.get_timestamps()))
+    else:
+        while not models_ready.wait(1.):
+            if os.getppid() != parent_pid:
+                capture.release()
+                ring.close()
+                ring.unlink()
+                return
+        # the first frames are stale once the models are loaded
+        free.put(slot)
+
+    # the last slot is never published: frames read while the consumer holds every other slot land there
+    scratch_slot = num_slots - 1
+    watchdog = WDT(logger, check_interval_sec=30, trigger_delta_sec=120, callback=partial(_restart, logger, pid, parent_pid))
+    while os.getppid() == parent_pid:
+        try:
+            slot = free.get_nowait()
+        except queue.Empty:
+            slot = scratch_slot
+        if not capture.read_into(ring.get_frames(slot)):
+            # a dead live stream stops feeding the watchdog, which restarts the run
+            time.sleep(0.1)
+            continue
+        watchdog.update()
+        if slot == scratch_slot:
+            with dropped.get_lock():
+                dropped.value += 1
+            continue
+        ready.put(('frames', slot, capture.get_timestamps()))
+
+    ready.put(None)
+    watchdog.stop()
+    capture.release()
+    ring.close()
+    if os.getppid() != parent_pid:
+        # the consumer is gone without unlinking the block
+        ring.unlink()
+
+
+class SharedMemoryCapture:
+    """Runs the capture in a separate process and receives frame sets through shared memory
+
+    get_nowait() returns (frames, timestamps) like FrameChannel. The frames are views into
+    the shared ring and stay valid until the next call, when their slot is handed back
+    to the capture process.
+    """
+
+    def __init__(self, logger, sources, pid, max_queue_length=2, init_timeout=120, capture_args=None,
+                 models_ready=None):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory capture requires Python 3.8 or newer')
+        self.logger = logger
+        # consumer holds one slot, the capture process keeps one scratch slot
+        self.num_slots = max_queue_length + 2
+        self.ready = mp.Queue()
+        self.free = mp.Queue()
+        self.shared_dropped = mp.Value('L', 0)
+        self.consumer_dropped = 0
+        for slot in range(self.num_slots - 1):
+            self.free.put(slot)
+
+        self.capture_process = mp.Process(target=_capture_process_body,
+                                          args=(logger, sources, capture_args or {}, pid, os.getpid(), self.num_slots,
+                                                self.ready, self.free, self.shared_dropped, models_ready),
+                                          daemon=True)
+        self.capture_process.start()
+
+        msg = self.ready.get(timeout=init_timeout)
+        if msg is None:
+            raise RuntimeError('Shared memory capture could not read the first frames')
+        _, name, shapes = msg
+        self.ring = SharedFrameRing(shapes, self.num_slots, name=name, create=False)
+        self.held_slot = None
+        self.process = True
+
+    @property
+    def dropped(self):
+        return self.shared_dropped.value + self.consumer_dropped
+
+    def get_num_sources(self):
+        return len(self.ring.shapes)
+
+    def get_nowait(self):
+        """Returns the newest published frame set and its timestamps, older pending ones are dropped"""
+        slots = []
+        while True:
+            try:
+                msg = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            if msg is None:
+                self.process = False
+                break
+            slots.append(msg[1:])
+        if not slots:
+            raise queue.Empty
+
+        for slot, _ in slots[:-1]:
+            self.free.put(slot)
+            self.consumer_dropped += 1
+        self._release()
+        self.held_slot, timestamps = slots[-1]
+        return self.ring.get_frames(self.held_slot), timestamps
+
+    def empty(self):
+        return self.ready.empty()
+
+    def _release(self):
+        if self.held_slot is not None:
+            self.free.put(self.held_slot)
+            self.held_slot = None
+
+    def close(self):
+        self.capture_process.terminate()
+        self.capture_process.join()
+        self.ring.close()
+        self.ring.unlink()
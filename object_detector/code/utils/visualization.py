@@ -46,8 +46,13 @@ def draw_detections(frame, detections,  labels_map):
 def visualize_detections(frames, all_objects, labels_map, fps=''):
     assert len(frames) == len(all_objects)
     vis = None
+    shape = next(frame.shape for frame in frames if frame is not None)
     for frame, objects in zip(frames, all_objects):
-        new_frame = draw_detections(frame, objects, labels_map)
+        if frame is None:
+            # camera missing from the frame set
+            new_frame = np.zeros(shape, dtype=np.uint8)
+        else:
+            new_frame = draw_detections(frame, objects, labels_map)
         if vis is not None:
             vis = np.vstack([vis, new_frame])
         else:
@@ -61,3 +66,12 @@ def visualize_detections(frames, all_objects, labels_map, fps=''):
     cv.putText(vis, str(fps), (base_line*2, base_line*3),
                cv.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
     return vis
+
+
+def visualize_models(frames, all_model_objects, labels_maps, fps=''):
+    """Visualizes the detections of several models, all drawn on the same frames"""
+    for all_objects, labels_map in zip(all_model_objects[:-1], labels_maps[:-1]):
+        for frame, objects in zip(frames, all_objects):
+            if frame is not None:
+                draw_detections(frame, objects, labels_map)
+    return visualize_detections(frames, all_model_objects[-1], labels_maps[-1], fps)
@@ -0,0 +1,202 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+"""
+ Parallel backfill of a recorded video: the file is split in time segments that are
+ tracked by a pool of workers, each one with its own Detector, VectorCNN and tracker.
+ Tracks crossing a segment boundary are stitched by appearance (or by box overlap
+ without a reid model) and the tracked objects are sent in order with global ids.
+"""
+
+import argparse
+import multiprocessing as mp
+import logging as log
+import sys
+
+import numpy as np
+
+from defaults import DEFAULT_SERVER, DEFAULT_PORT, DEFAULT_TABLE_NAME, DEFAULT_STAT_TABLE_NAME, \
+    DEFAULT_INFO_TABLE_NAME, DEFAULT_SOURCE, date_arg
+from log_sender import Log
+from mc_tracker.mct import MultiCameraTracker
+from mc_tracker.sct import TrackedObj
+from utils.autotune import worker_config
+from utils.misc import read_py_config
+from utils.network_wrappers import Detector, VectorCNN
+from utils.segments import recording_info, split_segments, read_segment
+
+log.basicConfig(stream=sys.stdout, level=log.DEBUG)
+
+worker = {}
+
+
+def init_worker(params):
+    logger = Log(params.tdetect, params.tstat, params.tinfo, params.source, False, params.devo_server, params.devo_port)
+    # every worker gets its share of the cores instead of one inference thread per core each
+    config = worker_config(params.device, params.workers)
+    worker['detector'] = Detector(logger, params.m_detector, params.t_detector, params.device, params.cpu_extension, 1,
+                                  config=config)
+    worker['recognizer'] = VectorCNN(logger, params.m_reid, params.device, config=config) if params.m_reid else None
+    worker['config'] = read_py_config(params.config) if len(params.config) else {}
+    worker['frame_step'] = params.frame_step
+
+
+def track_segment(segment):
+    """Tracks a segment, returns the frame positions, the frame shape and the confirmed tracks"""
+    path, start, end = segment
+    tracker = MultiCameraTracker(1, worker['recognizer'], **worker['config'])
+    positions = []
+    shape = None
+    for position, frame in read_segment(path, start, end, worker['frame_step']):
+        detections = worker['detector'].get_detections([frame])
+        # the tracker takes the boxes and the optional masks, like in the live run loop
+        masks = [[det[2] for det in dets if len(det) == 3] for dets in detections]
+        tracker.process([frame], [[det[0] for det in dets] for dets in detections], masks)
+        positions.append(position)
+        shape = frame.shape
+
+    sct = tracker.scts[0]
+    tracks = []
+    for track in sct.get_archived_tracks() + sct.get_tracks():
+        # same confirmation rule as the live tracked objects
+        if len(track['timestamps']) > sct.time_window:
+            tracks.append({'id': track['id'],
+                           'positions': [positions[t] for t in track['timestamps']],
+                           'boxes': track['boxes'],
+                           'avg_feature': track['avg_feature']})
+    return positions, shape, tracks
+
+
+def _iou(b1, b2):
+    x_left, y_top = max(b1[0], b2[0]), max(b1[1], b2[1])
+    x_right, y_bottom = min(b1[2], b2[2]), min(b1[3], b2[3])
+    intersection = max(x_right - x_left, 0) * max(y_bottom - y_top, 0)
+    union = (b1[2] - b1[0]) * (b1[3] - b1[1]) + (b2[2] - b2[0]) * (b2[3] - b2[1]) - intersection
+    return intersection / union if union > 0 else 0.
+
+
+def _stitch_distance(ending, starting):
+    if ending['avg_feature'] is not None and starting['avg_feature'] is not None:
+        f1, f2 = ending['avg_feature'], starting['avg_feature']
+        return 1. - np.dot(f1, f2) / (np.linalg.norm(f1) * np.linalg.norm(f2) + 1e-9)
+    return 1. - _iou(ending['boxes'][-1], starting['boxes'][0])
+
+
+class TrackStitcher:
+    """Assigns global ids to per segment tracks, continuing the tracks cut by a segment boundary"""
+
+    def __init__(self, boundary_window, match_thresh):
+        self.boundary_window = boundary_window
+        self.match_thresh = match_thresh
+        self.last_global_id = 0
+        self.open_tracks = []
+
+    def _next_id(self):
+        self.last_global_id += 1
+        return self.last_global_id - 1
+
+    def stitch(self, segment, tracks):
+        """Returns the local to global id mapping of a segment"""
+        _, start, end = segment
+        starting = [track for track in tracks if track['positions'][0] <= start + self.boundary_window]
+        pairs = sorted((_stitch_distance(ending, track), i, j)
+                       for i, (ending, _) in enumerate(self.open_tracks)
+                       for j, track in enumerate(starting))
+
+        mapping = {}
+        used_ending, used_starting = set(), set()
+        for distance, i, j in pairs:
+            if distance >= self.match_thresh:
+                break
+            if i in used_ending or j in used_starting or starting[j]['id'] in mapping:
+                continue
+            used_ending.add(i)
+            used_starting.add(j)
+            mapping[starting[j]['id']] = self.open_tracks[i][1]
+        for track in tracks:
+            if track['id'] not in mapping:
+                mapping[track['id']] = self._next_id()
+
+        self.open_tracks = [(track, mapping[track['id']]) for track in tracks
+                            if track['positions'][-1] >= end - self.boundary_window]
+        return mapping
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Person Tracker parallel backfill of a recorded video')
+    parser.add_argument('-i', type=str, help='Path to the video file', required=True)
+    parser.add_argument('-m', '--m_detector', type=str,
+                        help='Path to the person detection model',
+                        default='models/detector/person-detection-retail-0013.xml')
+    parser.add_argument('--t_detector', type=float, default=0.6, help='Threshold for the person detection model')
+    parser.add_argument('--m_reid', type=str,
+                        help='Path to the person reidentification model',
+                        default='models/detector/person-reidentification-retail-0079.xml')
+    parser.add_argument('--config', type=str, default='', required=False)
+    parser.add_argument('-d', '--device', type=str, default='CPU')
+    parser.add_argument("-l", "--cpu_extension",
+                        help="Optional. Required for CPU custom layers. "
+                             "Absolute path to a shared library with the kernels implementations inside the docker",
+                        type=str,
+                        default='/root/inference_engine_samples_build/intel64/Release/lib/libcpu_extension.so')
+    parser.add_argument('-w', '--workers', help='Number of worker processes', default=mp.cpu_count(), type=int)
+    parser.add_argument('--segment_length', help='Segment length (in seconds)', default=600, type=float)
+    parser.add_argument('--frame_step', help='Process one frame out of frame_step', default=1, type=int)
+    parser.add_argument('--stitch_window', help='Tracks ending or starting this close to a segment boundary '
+                                                '(in seconds) are stitched', default=2., type=float)
+    parser.add_argument('--stitch_thresh', help='Maximum distance (cosine of the reid features, or 1 - IoU '
+                                                'of the boundary boxes) to stitch two tracks', default=0.35, type=float)
+    parser.add_argument("--replay_start", help='Recording start date (YYYY/MM/DD HH:MM:SS). '
+                                               'Default: file modification time minus its duration',
+                        type=date_arg)
+    parser.add_argument('-dt', '--tdetect', help='Object Detected Table Name.', default=DEFAULT_TABLE_NAME, type=str)
+    parser.add_argument('-st', '--tstat', help='Stats Table Name.', default=DEFAULT_STAT_TABLE_NAME, type=str)
+    parser.add_argument('-it', '--tinfo', help='Info Table Name.', default=DEFAULT_INFO_TABLE_NAME, type=str)
+    parser.add_argument('-ds', '--devo_server', help='Devo Server.', default=DEFAULT_SERVER, type=str)
+    parser.add_argument('-dp', '--devo_port', help='Devo Port.', default=DEFAULT_PORT, type=str)
+    parser.add_argument('-log', "--sendlogs", help='Send Logs to Devo Platform', action="store_true")
+    parser.add_argument('-s', "--source", help='Stream source identifier', type=str, default=DEFAULT_SOURCE)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = getArgs()
+    logger = Log(args.tdetect, args.tstat, args.tinfo, args.source, args.sendlogs, args.devo_server, args.devo_port)
+
+    duration, recording_start = recording_info(args.i)
+    start = (args.replay_start if args.replay_start is not None else recording_start) * 1000
+    segments = split_segments(args.i, duration, args.segment_length * 1000)
+    logger.info("INFO", "Backfilling %s: %d segments on %d workers" % (args.i, len(segments), args.workers))
+
+    stitcher = TrackStitcher(args.stitch_window * 1000, args.stitch_thresh)
+    pool = mp.Pool(args.workers, initializer=init_worker, initargs=(args,))
+    # imap keeps the segment order: every segment is stitched to the previous one and sent right away
+    for segment, (positions, shape, tracks) in zip(segments, pool.imap(track_segment, segments)):
+        mapping = stitcher.stitch(segment, tracks)
+        objects = {position: [] for position in positions}
+        for track in tracks:
+            for position, box in zip(track['positions'], track['boxes']):
+                objects[position].append(TrackedObj(box, mapping[track['id']]))
+        for position in positions:
+            if objects[position]:
+                logger.detection_events([shape], [objects[position]], [start + position])
+        logger.info("INFO", "Segment ending at %.1fs done, %d tracks" % (segment[2] / 1000, len(tracks)))
+    pool.close()
+    pool.join()
+    logger.info("INFO", "Backfill finished: %d persons" % stitcher.last_global_id)
+
+
+if __name__ == '__main__':
+    main()
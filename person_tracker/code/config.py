@@ -14,5 +14,7 @@ sct_config = dict(
     n_clusters=4,
     max_bbox_velocity=0.2,
     detection_occlusion_thresh=0.7,
-    track_detection_iou_thresh=0.5
+    track_detection_iou_thresh=0.5,
+    reid_reuse_iou=0.9,
+    reid_refresh_interval=10
 )
@@ -0,0 +1,29 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissi#ons and
+ limitations under the License.
+"""
+
+"""
+ Defaults and argument helpers shared by the live script and the backfill
+"""
+
+import time
+
+DEFAULT_SERVER = "eu.elb.relay.logtrust.net"
+DEFAULT_PORT = 443
+DEFAULT_TABLE_NAME = 'my.app.person_tracker.tracking'
+DEFAULT_STAT_TABLE_NAME = 'my.app.person_tracker.stats'
+DEFAULT_INFO_TABLE_NAME = 'my.app.person_tracker.info'
+DEFAULT_SOURCE = "unknown"
+
+
+def date_arg(value):
+    return time.mktime(time.strptime(value, "%Y/%m/%d %H:%M:%S"))
@@ -32,8 +32,13 @@ class Log:
                                             chain=CHAIN)
         return Sender(engine_config)
 
-    def detections(self, frames, detections):
-        self._log_detection(self.tdetection, frames, detections)
+    def detections(self, frames, detections, timestamps=None):
+        shapes = [frame.shape if frame is not None else None for frame in frames]
+        self._log_detection(self.tdetection, shapes, detections, timestamps)
+
+    def detection_events(self, shapes, detections, timestamps):
+        """Logs detections computed elsewhere (e.g. backfill workers) from the frame shapes only"""
+        self._log_detection(self.tdetection, shapes, detections, timestamps)
 
     def stats(self, stats):
         self._log_stat(self.tstat, stats)
@@ -87,27 +92,34 @@ class Log:
         encodedStr = str(jpg_as_text, "utf-8")
         return 'jpg;base64; ' + encodedStr
 
-    def __log_detections(self, table, cam, frame, detections, dateTimeObj):
+    def __log_detections(self, table, cam, shape, detections, dateTimeObj):
         """Draws detections and labels"""
-        msg = "cam_" + str(cam) + "|" + str(frame.shape[0]) + "|" + str(frame.shape[1]) + "|" + self.source \
+        msg = "cam_" + str(cam) + "|" + str(shape[0]) + "|" + str(shape[1]) + "|" + self.source \
             + "|" + dateTimeObj.strftime("%Y/%m/%d %H:%M:%S")
 
         for i, obj in enumerate(detections):
-            msg1 = self._build_msg(msg, obj, frame)
+            msg1 = self._build_msg(msg, obj, None)
             self._sendMsg(table, msg1)
 
-    def _log_detection(self, table,  frames, all_objects):
-        assert len(frames) == len(all_objects)
+    def _log_detection(self, table,  shapes, all_objects, timestamps=None):
+        assert len(shapes) == len(all_objects)
         cam=0
         dateTimeObj = datetime.datetime.now()
-        for frame, objects in zip(frames, all_objects):
-            self.__log_detections(table, cam, frame, objects, dateTimeObj)
+        for shape, objects in zip(shapes, all_objects):
+            if shape is not None:
+                if timestamps is not None:
+                    # replayed recordings are dated with the frame timestamps (ms)
+                    dateTimeObj = datetime.datetime.fromtimestamp(timestamps[cam] / 1000.)
+                self.__log_detections(table, cam, shape, objects, dateTimeObj)
             cam=cam+1
 
     def _log_stat(self, table, stats):
         msg_stat = self.source + "|" + str((stats['cap.end'] - stats['cap.start']) * 1000) \
                    + "|" + str((stats['inference.end'] - stats['inference.start']) * 1000) \
-                   + "|" + str((stats['end'] - stats['start']) * 1000)
+                   + "|" + str((stats['end'] - stats['start']) * 1000) \
+                   + "|" + str(stats.get('frames.dropped', 0)) \
+                   + "|" + str(stats.get('cache.hits', 0)) + "|" + str(stats.get('cache.misses', 0)) \
+                   + "|" + str(stats.get('motion.skipped', 0)) + "|" + str(stats.get('frames.skipped', 0))
         self._sendMsg(table, msg_stat)
 
     def _log_info(self, table, type, msg):
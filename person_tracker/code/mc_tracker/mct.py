@@ -44,7 +44,9 @@ class MultiCameraTracker:
                 mask = masks[i]
             else:
                 mask = None
-            sct.process(frames[i], all_detections[i], mask)
+            if frames[i] is not None:
+                # cameras missing from the frame set keep their tracks untouched
+                sct.process(frames[i], all_detections[i], mask)
             all_tracks += sct.get_tracks()
 
         if self.time > 0 and self.time % self.time_window == 0:
@@ -15,7 +15,6 @@ import random
 from copy import deepcopy as copy
 from collections import namedtuple
 
-import cv2
 import numpy as np
 from scipy.optimize import linear_sum_assignment
 from scipy.spatial.distance import cosine, cdist
@@ -87,7 +86,9 @@ class SingleCameraTracker:
                  n_clusters=4,
                  max_bbox_velocity=0.2,
                  detection_occlusion_thresh=0.7,
-                 track_detection_iou_thresh=0.5):
+                 track_detection_iou_thresh=0.5,
+                 reid_reuse_iou=0.9,
+                 reid_refresh_interval=10):
         self.reid_model = reid_model
         self.global_id_getter = global_id_getter
         self.global_id_releaser = global_id_releaser
@@ -104,6 +105,9 @@ class SingleCameraTracker:
         self.max_bbox_velocity = max_bbox_velocity
         self.detection_occlusion_thresh = detection_occlusion_thresh
         self.track_detection_iou_thresh = track_detection_iou_thresh
+        self.reid_reuse_iou = reid_reuse_iou
+        self.reid_refresh_interval = reid_refresh_interval
+        self.fresh_embeddings = []
 
     def process(self, frame, detections, mask=None):
         reid_features = [None]*len(detections)
@@ -191,6 +195,8 @@ class SingleCameraTracker:
                     self.tracks[idx]['boxes'].append(detections[i])
                     self.tracks[idx]['timestamps'].append(self.time)
                     self.tracks[idx]['features'].append(features[i])
+                    if features[i] is not None and self.fresh_embeddings[i]:
+                        self.tracks[idx]['reid_time'] = self.time
                     if features[i] is not None:
                         self.tracks[idx]['f_cluster'].update(features[i])
                         if self.tracks[idx]['avg_feature'] is None:
@@ -301,6 +307,7 @@ class SingleCameraTracker:
                 'boxes': [rect],
                 'timestamps': [timestamp],
                 'features': [feature],
+                'reid_time': timestamp,
                 'avg_feature': feature.copy() if feature is not None else None,
                 'f_cluster': ClusterFeature(self.n_clusters, feature)}
 
@@ -360,21 +367,33 @@ class SingleCameraTracker:
         m = a1
         return intersecion / m if m > 0 else 0
 
+    def _get_reusable_embeddings(self, detections):
+        """Embeddings of the tracks whose last box barely moved, their re-id is not run again"""
+        reusable = [None]*len(detections)
+        candidates = [track for track in self.tracks
+                      if track['timestamps'][-1] == self.time - 1 and track['features'][-1] is not None and
+                      self.time - track['reid_time'] < self.reid_refresh_interval]
+        for track in candidates:
+            ious = [self._iou(track['boxes'][-1], det) for det in detections]
+            if ious:
+                i = int(np.argmax(ious))
+                if ious[i] > self.reid_reuse_iou and reusable[i] is None:
+                    # feature vectors are updated in place by the clusters, never share them
+                    reusable[i] = track['features'][-1].copy()
+        return reusable
+
     def _get_embeddings(self, frame, detections, mask=None):
-        rois = []
-        embeddings = []
-        for i in range(len(detections)):
-            rect = detections[i]
-            left, top, right, bottom = rect
-            crop = frame[top:bottom, left:right]
-            if mask and len(mask[i]) > 0:
-                crop = cv2.bitwise_and(crop, crop, mask=mask[i])
-            if left != right and top != bottom:
-                rois.append(crop)
-
-        if rois:
-            embeddings = self.reid_model.forward(rois)
-            assert len(rois) == len(embeddings)
+        embeddings = self._get_reusable_embeddings(detections)
+        self.fresh_embeddings = [embedding is None for embedding in embeddings]
+        to_compute = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not to_compute:
+            return embeddings
+
+        outputs, rois_idx = self.reid_model.forward_rois(frame, [detections[i] for i in to_compute],
+                                                         [mask[i] for i in to_compute] if mask else None)
+        # empty boxes have no roi and keep a None embedding
+        for j, embedding in zip(rois_idx, outputs):
+            embeddings[to_compute[j]] = embedding
 
         return embeddings
 
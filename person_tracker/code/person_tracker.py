@@ -13,22 +13,30 @@
 
 import argparse
 import queue
+from collections import deque
 from threading import Thread
 import time
 
 import cv2 as cv
 
+from defaults import DEFAULT_SERVER, DEFAULT_PORT, DEFAULT_TABLE_NAME, DEFAULT_STAT_TABLE_NAME, \
+    DEFAULT_INFO_TABLE_NAME, DEFAULT_SOURCE, date_arg
 from log_sender import Log
 
 from utils.network_wrappers import Detector, VectorCNN
 from mc_tracker.mct import MultiCameraTracker
+from utils.autotune import autotune
+from utils.detection_cache import CachedDetector
 from utils.misc import read_py_config
-from utils.streaming import MultiStreamerCapture
+from utils.motion import MotionGatedDetector
+from utils.scheduler import FrameScheduler
+from utils.streaming import MultiStreamerCapture, FrameChannel
+from utils.shm_transport import SharedMemoryCapture
 from utils.visualization import visualize_multicam_detections
 
 from watchdog_timer import WDT
 import os
-from multiprocessing import Process
+from multiprocessing import Process, Event
 from functools import partial
 import signal
 import logging as log
@@ -36,12 +44,6 @@ import sys
 
 log.basicConfig(stream=sys.stdout, level=log.DEBUG)
 
-DEFAULT_SERVER = "eu.elb.relay.logtrust.net"
-DEFAULT_PORT = 443
-DEFAULT_TABLE_NAME = 'my.app.person_tracker.tracking'
-DEFAULT_STAT_TABLE_NAME = 'my.app.person_tracker.stats'
-DEFAULT_INFO_TABLE_NAME = 'my.app.person_tracker.info'
-DEFAULT_SOURCE = "unknown"
 
 def isObjectsInLabels(objects, labels):
     return all(elem in labels for elem in objects)
@@ -55,14 +57,16 @@ def assert_exit(condition, err_message):
 
 
 class FramesThreadBody:
-    def __init__(self, logger, capture, timer, pid, max_queue_length=2):
+    def __init__(self, logger, capture, pid, max_queue_length=2, drop_policy='oldest', ready=None, replay=False):
         self.process = True
-        self.frames_queue = queue.Queue()
+        self.replay = replay
+        self.ready = ready
+        self.frames_queue = FrameChannel(max_queue_length, drop_policy)
         self.capture = capture
         self.max_queue_length = max_queue_length
-        self.timer = timer
         self.pid = pid
         self.logger = logger
+        self.poll_interval = 0.005
     
     def restart(self):
         try:
@@ -74,42 +78,93 @@ class FramesThreadBody:
             pass
 
     def __call__(self):
+        if self.ready is not None:
+            # frames read while the models load would only pile up as a stale backlog
+            self.ready.wait()
+        self.capture.start()
         watchdog = WDT(self.logger, check_interval_sec=30, trigger_delta_sec=120, callback=self.restart)
-        while True:
-            if self.frames_queue.qsize() > self.max_queue_length:
-                time.sleep(self.timer)
+        while self.process:
             has_frames, frames = self.capture.get_frames()
-            watchdog.update()
-            if not has_frames and self.frames_queue.empty():
+            if has_frames:
+                watchdog.update()
+                item = (frames, self.capture.get_timestamps())
+                if self.replay:
+                    # the replay queue blocks when full: give up when the run loop stops early
+                    while self.process and not self.frames_queue.put(item, timeout=self.poll_interval * 20):
+                        watchdog.update()
+                else:
+                    self.frames_queue.put(item)
+            elif self.capture.is_running():
+                # threaded capture: readers are still decoding the next frame set
+                time.sleep(self.poll_interval)
+            elif not self.replay:
+                # a dead live capture stops feeding the watchdog, which restarts the run
+                time.sleep(self.poll_interval)
+            elif self.frames_queue.empty():
                 self.process = False
                 break
-            if has_frames:
-                self.frames_queue.put(frames)
+            else:
+                # replay finished, the run loop is still consuming the queued frame sets
+                time.sleep(self.poll_interval)
+        watchdog.stop()
+        self.capture.release()
 
 def run(params, pid, logger):
 
-    capture = MultiStreamerCapture(logger, params.i)
-    thread_body = FramesThreadBody(logger, capture, params.processing_timer, pid,
-                                   max_queue_length=len(capture.captures) * 2)
-    frames_thread = Thread(target=thread_body)
-    frames_thread.start()
+    num_sources = len(params.i)
+    max_queue_length = params.queue_depth or num_sources * 2
+    capture_args = dict(decode_size=params.decode_size, decode_fps=params.decode_fps)
+    # set once the models are loaded and warmed up, the capture starts consuming frames then
+    models_ready = Event()
+    if params.shm_capture and not params.replay:
+        frames_queue = SharedMemoryCapture(logger, params.i, pid, max_queue_length=max_queue_length,
+                                           capture_args=capture_args, models_ready=models_ready)
+        frames_thread = None
+    else:
+        capture = MultiStreamerCapture(logger, params.i, params.threaded_capture, params.capture_buffer,
+                                       params.sync_tolerance, params.sync_offsets,
+                                       reconnect=params.reconnect, max_backoff=params.max_backoff,
+                                       replay=params.replay, replay_start=params.replay_start,
+                                       **capture_args)
+        thread_body = FramesThreadBody(logger, capture, pid,
+                                       max_queue_length=max_queue_length,
+                                       drop_policy='block' if params.replay else params.drop_policy,
+                                       ready=models_ready, replay=params.replay)
+        frames_queue = thread_body.frames_queue
+        frames_thread = Thread(target=thread_body)
+        frames_thread.start()
 
     person_detector = Detector(logger,
                                params.m_detector,
                                params.t_detector,
                                params.device, params.cpu_extension,
-                               capture.get_num_sources())
+                               num_sources, params.batch_inference, params.pipeline_depth,
+                               cache_dir=params.model_cache or None, server=params.inference_server or None,
+                               tuning_file=params.tuning_file, tile_grid=params.tile_grid,
+                               tile_overlap=params.tile_overlap, tile_regions=params.tile_region,
+                               tile_nms=params.tile_nms, warmup=params.warmup)
+    detection_cache = None
+    if params.frame_cache:
+        person_detector = detection_cache = CachedDetector(person_detector, num_sources, params.frame_cache_size,
+                                                           params.frame_cache_ttl)
+    motion_gate = None
+    if params.motion_gate:
+        person_detector = motion_gate = MotionGatedDetector(person_detector, num_sources, params.motion_sensitivity,
+                                                            params.motion_max_skip)
 
     if params.m_reid:
-        person_recognizer = VectorCNN(logger, params.m_reid, params.device)
+        person_recognizer = VectorCNN(logger, params.m_reid, params.device, params.reid_requests,
+                                      cache_dir=params.model_cache or None, server=params.inference_server or None,
+                                      tuning_file=params.tuning_file, warmup=params.warmup)
     else:
         person_recognizer = None
+    models_ready.set()
 
     config = {}
     if len(params.config):
         config = read_py_config(params.config)
 
-    tracker = MultiCameraTracker(capture.get_num_sources(), person_recognizer, **config)
+    tracker = MultiCameraTracker(num_sources, person_recognizer, **config)
 
     if params.broadcast:
         GST_PIPE = "appsrc is-live=1 \
@@ -127,7 +182,7 @@ def run(params, pid, logger):
 
 
     if len(params.output_video):
-        video_output_size = (1920 // capture.get_num_sources(), 1080)
+        video_output_size = (1920 // num_sources, 1080)
         fourcc = cv.VideoWriter_fourcc(*'XVID')
         output_video = cv.VideoWriter(params.output_video,
                                       fourcc, 24.0,
@@ -135,33 +190,72 @@ def run(params, pid, logger):
     else:
         output_video = None
 
+    rates = params.camera_fps or [1. / params.processing_timer if params.processing_timer > 0 else float('inf')]
+    if params.replay:
+        rates = [float('inf')]
+    assert_exit(len(rates) in (1, num_sources),
+                "--camera_fps needs one rate, or one per camera (%d cameras)" % num_sources)
+    assert_exit(not params.camera_priority or len(params.camera_priority) == num_sources,
+                "--camera_priority needs one priority per camera (%d cameras)" % num_sources)
+    if len(rates) == 1:
+        rates = rates * num_sources
+    scheduler = FrameScheduler(rates, params.camera_priority)
+
     stat = {}
+    in_flight = deque()
 
-    while cv.waitKey(1) != 27:
+    # replay runs unthrottled: the GUI is only polled when there is a window to show
+    poll_gui = params.debug or not params.replay
+    while not poll_gui or cv.waitKey(1) != 27:
+        if not in_flight:
+            # in flight results are collected first, they are not held back a camera period
+            time.sleep(scheduler.wait_time())
 
         stat['start'] = time.time()
         try:
             stat['cap.start'] = time.time()
-            frames = thread_body.frames_queue.get_nowait()
+            if params.replay and not in_flight:
+                # replay is not paced by the scheduler: wait for the next frame set instead of spinning
+                frames, timestamps = frames_queue.get(timeout=0.1)
+            else:
+                frames, timestamps = frames_queue.get_nowait()
             stat['cap.end'] = time.time()
         except queue.Empty:
             frames = None
 
-        if frames is None:
+        submitted = False
+        if frames is not None:
+            selected = scheduler.select([frame is not None for frame in frames])
+            if selected:
+                if frames_thread is None and params.pipeline_depth > 1:
+                    # shared memory slots are recycled on the next read, keep a copy while in flight
+                    frames = [frame.copy() for frame in frames]
+                # cameras that are not due are handled like missing ones
+                scheduled = [frame if i in selected else None for i, frame in enumerate(frames)]
+                submit_start = time.time()
+                person_detector.submit(scheduled)
+                scheduler.update(selected)
+                in_flight.append((frames, scheduled, timestamps, selected, submit_start, time.time() - submit_start))
+                submitted = True
+        elif params.replay and not thread_body.process and not in_flight:
+            break
+
+        # the newest frame set stays in flight while the oldest one is post processed
+        if not in_flight or (submitted and len(in_flight) < params.pipeline_depth):
             continue
-
-        stat['inference.start'] = time.time()
-        detections = person_detector.get_detections(frames)
-        all_detections = person_detector.get_detections(frames)
+        frames, scheduled, timestamps, selected, stat['inference.start'], submit_time = in_flight.popleft()
+        collect_start = time.time()
+        all_detections = person_detector.collect()
         all_masks = [[] for _ in range(len(all_detections))]
         for i, detections in enumerate(all_detections):
             all_detections[i] = [det[0] for det in detections]
             all_masks[i] = [det[2] for det in detections if len(det) == 3]
 
-        tracker.process(frames, all_detections, all_masks)
+        tracker.process(scheduled, all_detections, all_masks)
         tracked_objects = tracker.get_tracked_objects()
 
         stat['inference.end'] = time.time()
+        scheduler.add_cost(len(selected), submit_time + stat['inference.end'] - collect_start)
 
         if params.debug:
             fps = round(1 / (time.time() - stat['start']), 1)
@@ -176,16 +270,30 @@ def run(params, pid, logger):
                 out_send.write(visualize_multicam_detections(frames, tracked_objects, fps))
 
         stat['end'] = time.time()
+        stat['frames.dropped'] = frames_queue.dropped
+        if frames_thread is not None:
+            stat['frames.skipped'] = capture.get_skipped()
+        if detection_cache is not None:
+            stat['cache.hits'] = detection_cache.hits
+            stat['cache.misses'] = detection_cache.misses
+        if motion_gate is not None:
+            stat['motion.skipped'] = motion_gate.skipped
         if params.sendlogs:
-            logger.detections(frames, tracked_objects)
+            logger.detections(scheduled, tracked_objects, timestamps if params.replay else None)
             logger.stats(stat)
-        dif = params.processing_timer - (time.time() - stat['start'])
-        if (dif) > 0:
-            time.sleep(dif)
 
 
-    thread_body.process = False
-    frames_thread.join()
+    if frames_thread is not None:
+        thread_body.process = False
+        frames_thread.join()
+    else:
+        frames_queue.close()
+
+def autotune_models(params, logger):
+    """Finds the fastest inference settings of the detector and reid models for this host"""
+    autotune(logger, params.m_detector, params.device, params.cpu_extension, params.tuning_file, len(params.i))
+    if params.m_reid:
+        autotune(logger, params.m_reid, params.device, '', params.tuning_file)
 
 def signal_handler(process, logger):
     logger.info("INFO", "SIGNAL received. Terminating process....")
@@ -211,7 +319,7 @@ def getArgs():
                              "Absolute path to a shared library with the kernels implementations inside the docker",
                         type=str,
                         default='/root/inference_engine_samples_build/intel64/Release/lib/libcpu_extension.so')
-    parser.add_argument('-p', "--processing_timer", help='Processing time step (in seconds)', default=0.1, type=float)
+    parser.add_argument('-p', "--processing_timer", help='Processing time step (in seconds), default inference period of every camera', default=0.1, type=float)
     parser.add_argument('-dt', '--tdetect', help='Object Detected Table Name.', default=DEFAULT_TABLE_NAME, type=str)
     parser.add_argument('-st', '--tstat', help='Stats Table Name.', default=DEFAULT_STAT_TABLE_NAME, type=str)
     parser.add_argument('-it', '--tinfo', help='Info Table Name.', default=DEFAULT_INFO_TABLE_NAME, type=str)
@@ -221,6 +329,83 @@ def getArgs():
     parser.add_argument('-db', "--debug", help='Show a window with the image detection results', action="store_true")
     parser.add_argument('-log', "--sendlogs", help='Send Logs to Devo Platform', action="store_true")
     parser.add_argument('-s', "--source", help='Stream source identifier', type=str, default=DEFAULT_SOURCE)
+    parser.add_argument('-tc', "--threaded_capture", help='Read every camera in its own thread', action="store_true")
+    parser.add_argument("--capture_buffer", help='Ring buffer size (in frames) of every camera reader thread',
+                        default=2, type=int)
+    parser.add_argument("--sync_tolerance", help='Align the cameras on their frame timestamps: max time '
+                                                 'difference (in ms) inside a frame set, 0 disables it',
+                        default=0, type=float)
+    parser.add_argument("--sync_offsets", help='Per camera timestamp correction (in ms) used by --sync_tolerance. '
+                                               'Every stream is timed from its own first frame: a camera whose '
+                                               'content lags behind the others needs an offset',
+                        nargs='+', type=float)
+    parser.add_argument("--decode_size", help='Scale the decoded frames to WIDTH HEIGHT inside the capture '
+                                              'pipeline (detections are reported at this size)',
+                        nargs=2, type=int, metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument("--decode_fps", help='Drop frames inside the capture pipeline down to this rate', type=float)
+    parser.add_argument('-mg', "--motion_gate", help='Skip the detector on cameras whose frame did not change',
+                        action="store_true")
+    parser.add_argument("--motion_sensitivity", help='Fraction of changed pixels that counts as motion',
+                        default=0.005, type=float)
+    parser.add_argument("--motion_max_skip", help='Max consecutive frames a static camera can skip the detector',
+                        default=30, type=int)
+    parser.add_argument('-rc', "--reconnect", help='Reopen failed cameras with exponential backoff instead of '
+                                                   'restarting the whole process', action="store_true")
+    parser.add_argument("--max_backoff", help='Max delay (in seconds) between reconnection attempts',
+                        default=60, type=float)
+    parser.add_argument("--camera_fps", help='Target inference rate of every camera (one value per camera, '
+                                             'or a single value for all of them). Default: 1/processing_timer',
+                        nargs='+', type=float)
+    parser.add_argument("--camera_priority", help='Scheduling priority of every camera, higher is served first',
+                        nargs='+', type=int)
+    parser.add_argument('-r', "--replay", help='Process local video files as fast as possible, every frame, '
+                                               'dating the events with the frame timestamps', action="store_true")
+    parser.add_argument("--replay_start", help='Recording start date (YYYY/MM/DD HH:MM:SS) used by --replay. '
+                                               'Default: file modification time minus its duration',
+                        type=date_arg)
+    parser.add_argument("--queue_depth", help='Max frame sets waiting for inference (default: 2 per camera)',
+                        default=0, type=int)
+    parser.add_argument('-shm', "--shm_capture", help='Capture in a separate process and share the frames '
+                                                      'through shared memory. Requires Python 3.8+: not available '
+                                                      'in the docker image (Ubuntu 18.04, Python 3.6)',
+                        action="store_true")
+    parser.add_argument('-bi', "--batch_inference", help='Run the frames of all cameras through the detector '
+                                                         'as a single batch', action="store_true")
+    parser.add_argument("--pipeline_depth", help='Frame sets in flight in the detector: with 2 the next frame '
+                                                 'set is inferred while the previous one is post processed',
+                        default=1, type=int)
+    parser.add_argument("--model_cache", help='Directory of compiled networks reused across restarts, when the '
+                                              'device plugin can export them', default='', type=str)
+    parser.add_argument("--inference_server", help='Unix socket of a shared inference server '
+                                                   '(python3 -m utils.inference_server) running the models',
+                        default='', type=str)
+    parser.add_argument("--reid_requests", help='Infer requests of the reidentification model, crops beyond '
+                                                'that are streamed through them', default=8, type=int)
+    parser.add_argument("--autotune", help='Benchmark the models with different CPU streams, threads, infer '
+                                           'requests and batch sizes before starting, and keep the fastest',
+                        action="store_true")
+    parser.add_argument("--tuning_file", help='Autotune results, applied to the models tuned on the same CPU '
+                                              'model and core count',
+                        default='models/autotune.json', type=str)
+    parser.add_argument("--tile_grid", help='Also run the detector on COLS x ROWS overlapping tiles of the frame '
+                                            '(batched with the whole frame) to find small objects',
+                        nargs=2, type=int, metavar=('COLS', 'ROWS'))
+    parser.add_argument("--tile_overlap", help='Overlap between neighbour tiles (fraction of the tile size)',
+                        default=0.2, type=float)
+    parser.add_argument("--tile_region", help='Frame region to tile, relative coordinates (default: whole frame). '
+                                              'Can be repeated', action='append', nargs=4, type=float,
+                        metavar=('X0', 'Y0', 'X1', 'Y1'))
+    parser.add_argument("--tile_nms", help='IoU threshold merging the boxes found by several tiles',
+                        default=0.5, type=float)
+    parser.add_argument('-fc', "--frame_cache", help='Reuse the detections of frames already seen on the same '
+                                                 'camera (frozen or repeated stream frames)', action="store_true")
+    parser.add_argument("--frame_cache_size", help='Frames remembered per camera', default=8, type=int)
+    parser.add_argument("--frame_cache_ttl", help='Time (in seconds) a cached result stays valid',
+                        default=10., type=float)
+    parser.add_argument("--warmup", help='Warm-up inferences run by every infer request on synthetic input '
+                                         'before the capture starts', default=1, type=int)
+    parser.add_argument("--drop_policy", help='Frame set to drop when the frame queue is full',
+                        choices=FrameChannel.DROP_POLICIES, default='oldest')
 
     args = parser.parse_args()
     return args
@@ -231,11 +416,19 @@ def main():
     timesRestarted = 0
     pid = os.getpid()
     logger = Log(args.tdetect, args.tstat, args.tinfo, args.source, args.sendlogs, args.devo_server, args.devo_port)
+    if args.autotune:
+        # tuned in a child process, the inference processes start with a clean Inference Engine
+        tuner = Process(target=autotune_models, args=(args, logger))
+        tuner.start()
+        tuner.join()
     while True:
         process = Process(target=run, args = (args, pid, logger))
         signal.signal(signal.SIGUSR1, partial(signal_handler, process, logger))
         process.start()
         process.join()
+        if args.replay and process.exitcode == 0:
+            logger.info("INFO", "Replay finished")
+            break
         timesRestarted += 1
         logger.info("INFO", "RESTARTED ****************************************** %s" % (timesRestarted))
 
@@ -0,0 +1,96 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+def frame_hash(frame, step=4):
+    """Exact digest of the frame subsampled every step pixels: only truly repeated frames
+    share it, any change larger than step pixels (a distant person entering) does not"""
+    sha = hashlib.blake2b(digest_size=16)
+    sha.update(str(frame.shape).encode())
+    sha.update(np.ascontiguousarray(frame[::step, ::step]).data)
+    return sha.digest()
+
+
+class FrameCache:
+    """Bounded LRU of detections keyed by frame hash, entries expire after ttl seconds"""
+
+    def __init__(self, max_size=8, ttl=10.):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        timestamp, detections = entry
+        if now - timestamp > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return detections
+
+    def put(self, key, detections, now):
+        self.entries[key] = (now, detections)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class CachedDetector:
+    """Wrapper returning the stored detections of frames already seen on the same camera
+
+    Frozen or duplicated stream frames hit the cache and skip the detector.
+    """
+
+    def __init__(self, detector, num_sources, max_size=8, ttl=10.):
+        self.detector = detector
+        self.caches = [FrameCache(max_size, ttl) for _ in range(num_sources)]
+        self.pending = deque()
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, frames):
+        """Starts the inference of the frames missing from the cache"""
+        now = time.time()
+        keys = [None if frame is None else frame_hash(frame) for frame in frames]
+        cached = [None if key is None else self.caches[i].get(key, now) for i, key in enumerate(keys)]
+        self.detector.submit([frame if cached[i] is None else None for i, frame in enumerate(frames)])
+        self.pending.append((keys, cached))
+
+        num_hits = sum(detections is not None for detections in cached)
+        self.hits += num_hits
+        self.misses += sum(key is not None for key in keys) - num_hits
+
+    def collect(self):
+        """Returns all detections of the oldest submitted frame set"""
+        keys, cached = self.pending.popleft()
+        detections = self.detector.collect()
+        now = time.time()
+        for i, key in enumerate(keys):
+            if cached[i] is not None:
+                detections[i] = cached[i]
+            elif key is not None:
+                self.caches[i].put(key, detections[i], now)
+        return detections
+
+    def get_detections(self, frames):
+        """Returns all detections on frames"""
+        self.submit(frames)
+        return self.collect()
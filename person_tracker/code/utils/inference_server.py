@@ -0,0 +1,258 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+"""
+ Local inference server shared by several detector processes.
+
+ Every model is loaded once, with a batch of --max_batch images. Requests from all
+ the clients are queued per model and run as dynamic batches: a batch starts when it
+ is full or when its oldest request has waited --max_latency seconds.
+
+ Run it from the application code directory, model names are resolved like in
+ load_ie_model:
+     python3 -m utils.inference_server --socket /tmp/inference.sock
+
+ Clients authenticate with the random key the server writes next to its socket
+ (SOCKET.key, readable by the server user only).
+"""
+
+import argparse
+import logging as log
+import os
+import queue
+import sys
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from threading import Thread, Lock
+
+import numpy as np
+import cv2 as cv
+
+from utils.ie_tools import load_ie_model, InputInfo
+
+
+def key_path(address):
+    return address + '.key'
+
+
+def write_authkey(address):
+    """Writes a new random key next to the socket, only readable by the current user"""
+    authkey = os.urandom(32)
+    fd = os.open(key_path(address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+def read_authkey(address):
+    with open(key_path(address), 'rb') as f:
+        return f.read()
+
+
+class RemoteIEModel:
+    """Client side IEModel running the inferences on an inference server"""
+
+    def __init__(self, logger, address, model_id):
+        self.logger = logger
+        self.model_id = model_id
+        self.conn = Client(address, family='AF_UNIX', authkey=read_authkey(address))
+        self.conn.send(('load', model_id))
+        status, shape = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError('Inference server cannot load %s: %s' % (model_id, shape))
+        self.input_shape = tuple(shape)
+        self.next_id = 0
+        self.results = {}
+        self.reqs_ids = []
+
+    def submit(self, img):
+        """Sends an image resized to the network input, returns its request id"""
+        _, _, h, w = self.input_shape
+        id = self.next_id
+        self.next_id += 1
+        self.conn.send(('infer', self.model_id, id, cv.resize(img, (w, h))))
+        return id
+
+    def collect(self, id):
+        """Waits for the output of a submitted request"""
+        while id not in self.results:
+            reply_id, res = self.conn.recv()
+            self.results[reply_id] = res
+        res = self.results.pop(id)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def forward(self, img):
+        return self.collect(self.submit(img))
+
+    def forward_async(self, img):
+        self.reqs_ids.append(self.submit(img))
+
+    def grab_all_async(self):
+        outputs = [self.collect(id) for id in self.reqs_ids]
+        self.reqs_ids = []
+        return outputs
+
+    def get_input_shape(self):
+        return InputInfo(self.input_shape)
+
+
+def split_output(out, num_imgs):
+    """Splits a batch output into per image outputs shaped like a batch of one"""
+    if out.shape[-1] == 7 and out.shape[0] == 1:
+        # SSD detection output: rows of every image, tagged with their image id
+        rows = out[0, 0]
+        end = np.flatnonzero(rows[:, 0] < 0)
+        if len(end):
+            rows = rows[:end[0]]
+        terminator = np.full((1, 7), -1, dtype=out.dtype)
+        outputs = []
+        for i in range(num_imgs):
+            image_rows = np.concatenate([rows[rows[:, 0] == i], terminator])
+            image_rows[:-1, 0] = 0
+            outputs.append(image_rows[None, None])
+        return outputs
+    return [out[i:i + 1] for i in range(num_imgs)]
+
+
+class InferenceServer:
+    """Serves the inference requests of many clients with per model dynamic batches"""
+
+    def __init__(self, logger, address, device='CPU', cpu_extension='', max_batch=8, max_latency=0.01,
+                 cache_dir=None):
+        self.logger = logger
+        self.address = address
+        self.device = device
+        self.cpu_extension = cpu_extension
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.cache_dir = cache_dir
+        self.models = {}
+        self.queues = {}
+        self.models_lock = Lock()
+
+    def _load(self, model_id):
+        with self.models_lock:
+            if model_id not in self.models:
+                self.models[model_id] = load_ie_model(self.logger, model_id, self.device, None, self.cpu_extension,
+                                                      batch_size=self.max_batch, cache_dir=self.cache_dir)
+                self.queues[model_id] = queue.Queue()
+                Thread(target=self._batch_loop, args=(model_id,), daemon=True).start()
+        return self.models[model_id]
+
+    def _next_batch(self, requests):
+        batch = [requests.get()]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _batch_loop(self, model_id):
+        model = self.models[model_id]
+        requests = self.queues[model_id]
+        while True:
+            batch = self._next_batch(requests)
+            try:
+                outputs = split_output(model.forward_batch([img for img, _, _, _ in batch]), len(batch))
+            except Exception as e:
+                # every client of the batch gets the error instead of waiting for its reply forever
+                self.logger.info("ERROR", "Inference of %s failed: %s" % (model_id, e))
+                outputs = [RuntimeError('Inference of %s failed: %s' % (model_id, e))] * len(batch)
+            for (_, id, conn, conn_lock), res in zip(batch, outputs):
+                try:
+                    with conn_lock:
+                        conn.send((id, res))
+                except (OSError, EOFError):
+                    # the client went away, its other replies are dropped as well
+                    pass
+
+    def _client_loop(self, conn):
+        conn_lock = Lock()
+        try:
+            while True:
+                msg = conn.recv()
+                if msg[0] == 'load':
+                    try:
+                        model = self._load(msg[1])
+                        reply = ('ok', model.get_input_shape().shape)
+                    except Exception as e:
+                        reply = ('error', str(e))
+                    with conn_lock:
+                        conn.send(reply)
+                elif msg[0] == 'infer':
+                    _, model_id, id, img = msg
+                    requests = self.queues.get(model_id)
+                    if requests is None:
+                        with conn_lock:
+                            conn.send((id, RuntimeError('Model %s is not loaded on the inference server' % model_id)))
+                        continue
+                    requests.put((img, id, conn, conn_lock))
+        except (OSError, EOFError):
+            pass
+        conn.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        listener = Listener(self.address, family='AF_UNIX', authkey=write_authkey(self.address))
+        self.logger.info("INFO", "Inference server listening on " + self.address)
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError, EOFError) as e:
+                # a client without the key, or gone during the handshake
+                self.logger.info("ERROR", "Inference server rejected a client: %s" % e)
+                continue
+            Thread(target=self._client_loop, args=(conn,), daemon=True).start()
+
+
+class _StdoutLogger:
+    def info(self, type, msg):
+        log.info("%s %s" % (type, msg))
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Local inference server with dynamic batching')
+    parser.add_argument('--socket', type=str, default='/tmp/inference.sock', help='Unix socket path')
+    parser.add_argument('-d', '--device', type=str, default='CPU')
+    parser.add_argument("-l", "--cpu_extension",
+                        help="Optional. Required for CPU custom layers. "
+                             "Absolute path to a shared library with the kernels implementations inside the docker",
+                        type=str,
+                        default='/root/inference_engine_samples_build/intel64/Release/lib/libcpu_extension.so')
+    parser.add_argument('--max_batch', help='Max images per inference', default=8, type=int)
+    parser.add_argument('--max_latency', help='Max time (in seconds) a request waits for its batch to fill',
+                        default=0.01, type=float)
+    parser.add_argument("--model_cache", help='Directory of compiled networks reused across restarts',
+                        default='', type=str)
+    return parser.parse_args()
+
+
+def main():
+    log.basicConfig(stream=sys.stdout, level=log.DEBUG)
+    args = getArgs()
+    server = InferenceServer(_StdoutLogger(), args.socket, args.device, args.cpu_extension,
+                             args.max_batch, args.max_latency, args.model_cache or None)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
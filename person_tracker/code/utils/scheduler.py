@@ -0,0 +1,73 @@
+"""
+ Copyright (c) 2019 Intel Corporation
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+      http://www.apache.org/licenses/LICENSE-2.0
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import time
+
+
+class FrameScheduler:
+    """Chooses the cameras to infer from per camera deadlines, priorities and measured inference cost
+
+    Every camera has a target rate; a camera is due once its deadline has passed.
+    Due cameras are served by priority and then by deadline, and lower priority
+    cameras are postponed when their estimated cost would make a higher priority
+    camera miss its next deadline.
+    """
+
+    def __init__(self, rates, priorities=None, smoothing=0.2):
+        assert all(rate > 0 for rate in rates)
+        self.periods = [1. / rate for rate in rates]
+        self.priorities = priorities if priorities else [0] * len(rates)
+        assert len(self.priorities) == len(self.periods)
+        self.deadlines = [0.] * len(rates)
+        self.smoothing = smoothing
+        self.frame_cost = 0.
+
+    def _slack(self, camera, now):
+        """Time left until the next deadline of a higher priority camera"""
+        deadlines = [deadline for i, deadline in enumerate(self.deadlines)
+                     if self.priorities[i] > self.priorities[camera] and deadline > now]
+        return min(deadlines) - now if deadlines else float('inf')
+
+    def select(self, available=None, now=None):
+        """Returns the indexes of the cameras to infer now"""
+        now = time.time() if now is None else now
+        due = [i for i, deadline in enumerate(self.deadlines)
+               if deadline <= now and (available is None or available[i])]
+        due.sort(key=lambda i: (-self.priorities[i], self.deadlines[i]))
+
+        selected = []
+        for i in due:
+            if selected and self.frame_cost * (len(selected) + 1) > self._slack(i, now):
+                continue
+            selected.append(i)
+        return selected
+
+    def update(self, selected, elapsed=None, now=None):
+        """Moves the deadlines of the inferred cameras and updates the inference cost estimate"""
+        now = time.time() if now is None else now
+        if elapsed is not None:
+            self.add_cost(len(selected), elapsed)
+        for i in selected:
+            # a camera running late is served as soon as possible, without catching up missed slots
+            self.deadlines[i] = max(self.deadlines[i] + self.periods[i], now)
+
+    def add_cost(self, num_frames, elapsed):
+        """Updates the inference cost estimate with the time spent on num_frames frames"""
+        if num_frames:
+            cost = elapsed / num_frames
+            self.frame_cost += self.smoothing * (cost - self.frame_cost) if self.frame_cost else cost
+
+    def wait_time(self, now=None):
+        """Returns how long to wait (in seconds) until the next camera is due"""
+        now = time.time() if now is None else now
+        return max(min(self.deadlines) - now, 0.)
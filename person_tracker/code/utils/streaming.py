@@ -1,4 +1,3 @@
-
 """
  Copyright (c) 2019 Intel Corporation
  Licensed under the Apache License, Version 2.0 (the "License");
@@ -12,46 +11,529 @@
  limitations under the License.
 """
 
+import math
+import os
+import queue
+import time
+from collections import deque
+from fractions import Fraction
+from functools import partial
+from threading import Thread, Lock, Condition
+
 import cv2 as cv
 
+# seconds a reconnected stream must deliver frames before the reconnection backoff is reset
+HEALTHY_TIME = 60.
+
+# frames buffered per camera at most to match delayed cameras, every one is a full decoded frame
+MAX_SYNC_BUFFER = 100
+
+
+class FrameChannel:
+    """Bounded frame queue that drops frames instead of growing when the consumer falls behind
+
+    drop_policy='oldest' overwrites the oldest queued frame set (latest frame wins),
+    drop_policy='newest' rejects the incoming frame set and keeps the queued ones,
+    drop_policy='block' never drops and makes the producer wait (offline replay).
+    """
+
+    DROP_POLICIES = ('oldest', 'newest')
+
+    def __init__(self, maxsize=2, drop_policy='oldest'):
+        assert maxsize > 0
+        assert drop_policy in self.DROP_POLICIES + ('block',)
+        self.items = deque()
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+
+    def put(self, item, timeout=None):
+        """Adds an item, returns False if a frame set has been dropped to make it fit
+
+        With the 'block' policy, returns False without adding the item when the queue
+        stayed full for timeout seconds.
+        """
+        with self.not_empty:
+            if self.drop_policy == 'block':
+                if not self.not_full.wait_for(lambda: len(self.items) < self.maxsize, timeout):
+                    return False
+            dropped = len(self.items) >= self.maxsize
+            if dropped:
+                self.dropped += 1
+                if self.drop_policy == 'newest':
+                    return False
+                self.items.popleft()
+            self.items.append(item)
+            self.not_empty.notify()
+        return not dropped
+
+    def get(self, timeout=None):
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: len(self.items) > 0, timeout):
+                raise queue.Empty
+            self.not_full.notify()
+            return self.items.popleft()
+
+    def get_nowait(self):
+        with self.not_empty:
+            if not self.items:
+                raise queue.Empty
+            self.not_full.notify()
+            return self.items.popleft()
+
+    def qsize(self):
+        with self.not_empty:
+            return len(self.items)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+def _build_pipeline(elements, sink, decode_size=None, decode_fps=None):
+    """Appends to the source elements the scaling, frame dropping and conversion elements"""
+    caps = []
+    elements = list(elements)
+    source_length = len(elements)
+    if decode_fps:
+        fps = Fraction(decode_fps).limit_denominator(1001)
+        elements.append("videorate drop-only=true")
+        caps.append("framerate={}/{}".format(fps.numerator, fps.denominator))
+    elements.append("videoscale")
+    if decode_size:
+        caps += ["width={}".format(decode_size[0]), "height={}".format(decode_size[1])]
+    if not caps:
+        return " ! ".join(elements[:source_length] + ["videoconvert", "videoscale", sink])
+    # scale and drop while still in the decoder colour space, convert only what is kept
+    elements += ["video/x-raw," + ",".join(caps), "videoconvert", "video/x-raw,format=BGR", sink]
+    return " ! ".join(elements)
+
+
+def build_hls_pipeline(stream_path, decode_size=None, decode_fps=None):
+    """Builds the GStreamer HLS pipeline, scaling and dropping frames before they reach appsink"""
+    return _build_pipeline(["souphttpsrc location=" + stream_path, "hlsdemux", "decodebin"],
+                           "appsink max-buffers=1 drop=true", decode_size, decode_fps)
+
+
+def build_file_pipeline(path, decode_size=None, decode_fps=None, realtime=True):
+    """Builds a local file pipeline, played at its own rate or as fast as possible (realtime=False)"""
+    sink = "appsink max-buffers=1 drop=true" if realtime else "appsink sync=false"
+    return _build_pipeline(["filesrc location=" + path, "decodebin"], sink, decode_size, decode_fps)
+
+
+class StreamClock:
+    """Maps the capture position (CAP_PROP_POS_MSEC, the stream PTS) to wall clock milliseconds
+
+    The clock is anchored to the arrival time of the first frame and re-anchored whenever
+    the position goes backwards or stands still (stream restarts, backends without PTS).
+    Each stream has its own anchor, so a content delay between cameras (one stream lagging
+    behind the others) is invisible to the timestamps: it has to be corrected with the offset.
+    With wall_clock=False (recorded files) the timestamp is the position plus the offset.
+    """
+
+    def __init__(self, offset=0., wall_clock=True):
+        self.offset = offset
+        self.wall_clock = wall_clock
+        self.anchor = None
+        self.last_pts = None
+
+    def timestamp(self, capture):
+        now = time.time() * 1000
+        pts = capture.get(cv.CAP_PROP_POS_MSEC)
+        if not self.wall_clock:
+            return pts + self.offset
+        if self.anchor is None or pts <= self.last_pts:
+            self.anchor = now - pts
+        self.last_pts = pts
+        return self.anchor + pts + self.offset
+
+
+class StreamReader:
+    """Reads frames from a single capture in its own thread into a ring buffer
+
+    When a reopen callable is given, a failing capture is released and reopened
+    with exponential backoff instead of stopping the reader.
+    """
+
+    def __init__(self, logger, capture, buffer_size=2, name='', clock=None, skip_before=None,
+                 reopen=None, max_backoff=60.):
+        self.logger = logger
+        self.capture = capture
+        self.name = name
+        self.clock = clock if clock is not None else StreamClock()
+        # callable returning a timestamp: older frames are grabbed but never decoded
+        self.skip_before = skip_before
+        self.skipped = 0
+        self.reopen = reopen
+        self.max_backoff = max_backoff
+        self.backoff = 1.
+        self.reconnections = 0
+        self.connected = capture is not None and capture.isOpened()
+        self.connected_time = time.time()
+        self.last_frame_time = time.time()
+        self.ring = deque(maxlen=buffer_size)
+        self.lock = Lock()
+        self.running = True
+        # a read thread only acts while its generation is current, a stalled one is abandoned
+        self.generation = 0
+        self.thread = Thread(target=self._read_loop, args=(self.generation,), name='reader_' + str(name), daemon=True)
+
+    def start(self):
+        self.connected_time = time.time()
+        self.last_frame_time = time.time()
+        self.thread.start()
+
+    def _read_loop(self, generation):
+        while self.running and generation == self.generation:
+            capture = self.capture
+            has_frame = self.connected and capture.grab()
+            if generation != self.generation:
+                # the supervisor replaced this thread while it was blocked
+                return
+            if has_frame:
+                timestamp = self.clock.timestamp(capture)
+                if self.skip_before is not None and timestamp < self.skip_before():
+                    self.skipped += 1
+                    continue
+                has_frame, frame = capture.retrieve()
+            if not has_frame:
+                if self.connected:
+                    self.logger.info('ERROR', 'Capture {} stopped delivering frames'.format(self.name))
+                else:
+                    # readers only start disconnected when the first open failed
+                    self.logger.info('ERROR', 'Capture {} could not be opened'.format(self.name))
+                if self.reopen is None or not self._reconnect(generation):
+                    break
+                continue
+            with self.lock:
+                self.ring.append((timestamp, frame))
+            self.last_frame_time = time.time()
+            if self.last_frame_time - self.connected_time > HEALTHY_TIME:
+                # the stream has been stable long enough, the next failure reconnects quickly again
+                self.backoff = 1.
+        if generation == self.generation:
+            self.running = False
+
+    def _reconnect(self, generation):
+        """Reopens the capture with exponential backoff, returns False if the reader was stopped meanwhile
+
+        The delay keeps growing across reconnections until the stream stays healthy for
+        HEALTHY_TIME seconds, so a flapping source is not reopened every second.
+        """
+        self.connected = False
+        with self.lock:
+            self.ring.clear()
+        if self.capture is not None:
+            self.capture.release()
+        while self.running and generation == self.generation:
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self.reconnections += 1
+            self.logger.info('INFO', 'Reconnecting capture {} (attempt {})'.format(self.name, self.reconnections))
+            capture = self.reopen()
+            if generation != self.generation:
+                if capture is not None:
+                    capture.release()
+                return False
+            if capture is not None and capture.isOpened():
+                self.capture = capture
+                self.clock.anchor = None
+                self.connected = True
+                self.connected_time = time.time()
+                self.last_frame_time = self.connected_time
+                self.logger.info('INFO', 'Capture {} reconnected'.format(self.name))
+                return True
+        return False
+
+    def _reopen_loop(self, generation):
+        if self._reconnect(generation):
+            self._read_loop(generation)
+
+    def restart_if_stalled(self, stale_timeout):
+        """Replaces a read thread blocked on a stalled capture (grab() never returning)
+
+        The stalled thread is abandoned, a new one reopens the source with the usual backoff.
+        Returns True if the reader was restarted.
+        """
+        if self.reopen is None or not self.connected or not self.running or \
+                time.time() - self.last_frame_time <= stale_timeout:
+            return False
+        self.logger.info('ERROR', 'Capture {} stalled for {:.0f} s, reopening it'
+                         .format(self.name, time.time() - self.last_frame_time))
+        self.generation += 1
+        self.connected = False
+        stalled, self.capture = self.capture, None
+        # releasing can block as long as the stalled read does
+        Thread(target=stalled.release, daemon=True).start()
+        self.thread = Thread(target=self._reopen_loop, args=(self.generation,), name='reader_' + str(self.name),
+                             daemon=True)
+        self.thread.start()
+        return True
+
+    def is_missing(self, stale_timeout):
+        """A camera is missing while reconnecting or when it has not delivered a frame for stale_timeout seconds"""
+        return not self.connected or time.time() - self.last_frame_time > stale_timeout
+
+    def get_latest(self):
+        """Pops the newest (timestamp, frame) dropping the older ones, or returns None if there is no fresh frame"""
+        with self.lock:
+            if not self.ring:
+                return None
+            item = self.ring[-1]
+            self.ring.clear()
+        return item
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.ring)
+
+    def drop_until(self, timestamp):
+        """Drops every buffered frame with a timestamp not newer than the given one"""
+        with self.lock:
+            while self.ring and self.ring[0][0] <= timestamp:
+                self.ring.popleft()
+
+    def has_frame(self):
+        with self.lock:
+            return len(self.ring) > 0
+
+    def stop(self, timeout=1):
+        self.running = False
+        self.thread.join(timeout)
+
 
 class MultiStreamerCapture:
-    def __init__(self, logger, sources):
+    """Reads frame sets from several cameras, HLS streams or local video files
+
+    With reconnect enabled every source is read in its own thread and reopened on
+    failure; cameras that are reconnecting (or stale) are reported as None in the
+    frame set instead of blocking it. A supervisor thread also reopens the sources
+    that stall (no frame for stale_timeout seconds, without any read error).
+    With replay enabled local files are decoded as fast as possible, frame by frame,
+    and timestamped with their own position from replay_start (epoch seconds, by
+    default the file modification time minus its duration).
+    """
+
+    def __init__(self, logger, sources, threaded=False, buffer_size=2, sync_tolerance=0, sync_offsets=None,
+                 decode_size=None, decode_fps=None, reconnect=False, max_backoff=60., stale_timeout=10.,
+                 replay=False, replay_start=None):
         assert sources
         self.logger = logger
         self.captures = []
+        self.readers = []
+        self.sync_tolerance = sync_tolerance
+        self.stale_timeout = stale_timeout
+        self.decode_size = decode_size
+        self.decode_fps = decode_fps
+        self.replay = replay
+        self.watermark = -float('inf')
+        self.supervising = True
+        self.supervisor = None
+        self.timestamps = []
 
         try:
-            sources = [int(src) for src in sources]
-            mode = 'cam'
+            self.sources = [int(src) for src in sources]
+            self.mode = 'cam'
         except ValueError:
-            mode = 'video'
-
-        if mode == 'cam':
-            for id in sources:
-                self.logger.info('INFO', 'Connection  cam {}'.format(id))
-                cap = cv.VideoCapture(id)
-                cap.set(cv.CAP_PROP_FRAME_WIDTH, 1280)
-                cap.set(cv.CAP_PROP_FPS, 30)
-                cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*'MJPG'))
-                assert cap.isOpened()
-                self.captures.append(cap)
+            self.sources = list(sources)
+            self.mode = 'file' if all(os.path.isfile(src) for src in self.sources) else 'video'
+        assert not replay or self.mode == 'file', 'Replay mode requires local video files'
+
+        for source in self.sources:
+            cap = self._open_capture(source)
+            assert reconnect or cap.isOpened()
+            self.captures.append(cap)
+
+        if replay:
+            starts = [replay_start] * len(self.captures) if replay_start is not None else \
+                [self._recording_start(cap, path) for cap, path in zip(self.captures, self.sources)]
+            self.clocks = [StreamClock(start * 1000, wall_clock=False) for start in starts]
+            # every frame is processed in order, frames are never dropped by reader threads
+            return
+
+        if sync_offsets is None:
+            sync_offsets = [0.] * len(self.captures)
+        assert len(sync_offsets) == len(self.captures)
+        self.clocks = [StreamClock(offset) for offset in sync_offsets]
+
+        if sync_tolerance > 0:
+            buffer_size = self._sync_buffer_size(buffer_size, sync_offsets)
+        if threaded or reconnect or sync_tolerance > 0:
+            skip_before = (lambda: self.watermark) if sync_tolerance > 0 else None
+            for i, cap in enumerate(self.captures):
+                reopen = partial(self._open_capture, self.sources[i]) if reconnect else None
+                self.readers.append(StreamReader(self.logger, cap, buffer_size, name=i,
+                                                 clock=self.clocks[i], skip_before=skip_before,
+                                                 reopen=reopen, max_backoff=max_backoff))
+            if reconnect:
+                self.supervisor = Thread(target=self._supervise, name='reader_supervisor', daemon=True)
+
+    def start(self):
+        """Starts the reader threads, nothing is decoded in the background before this call"""
+        for reader in self.readers:
+            reader.start()
+        if self.supervisor is not None:
+            self.supervisor.start()
+
+    def _sync_buffer_size(self, buffer_size, sync_offsets):
+        """Ring size holding every frame between the most and the least delayed camera
+
+        A camera's matching frame must still be in its ring when the most delayed camera
+        delivers its own, or the frame set can never be assembled.
+        """
+        rates = [cap.get(cv.CAP_PROP_FPS) for cap in self.captures if cap.isOpened()]
+        fps = self.decode_fps or max(rates + [0]) or 30
+        span = max(sync_offsets) - min(sync_offsets) + 2 * self.sync_tolerance
+        needed = int(math.ceil(span * fps / 1000.)) + 1
+        if needed > MAX_SYNC_BUFFER:
+            self.logger.info('ERROR', 'Sync offsets span {:.0f} ms, more than the {} buffered frames per camera: '
+                                      'frame sets of the most delayed cameras will not be matched'
+                             .format(span, MAX_SYNC_BUFFER))
+            needed = MAX_SYNC_BUFFER
+        if needed > buffer_size:
+            self.logger.info('INFO', 'Sync buffers {} frames per camera to cover {:.0f} ms'.format(needed, span))
+        return max(buffer_size, needed)
+
+    def _supervise(self, interval=1.):
+        """Reopens the readers whose capture stalled without reporting an error"""
+        while self.supervising:
+            for reader in self.readers:
+                reader.restart_if_stalled(self.stale_timeout)
+            time.sleep(interval)
+
+    def _open_capture(self, source):
+        if self.mode == 'cam':
+            self.logger.info('INFO', 'Connection  cam {}'.format(source))
+            cap = cv.VideoCapture(source)
+            cap.set(cv.CAP_PROP_FRAME_WIDTH, self.decode_size[0] if self.decode_size else 1280)
+            if self.decode_size:
+                cap.set(cv.CAP_PROP_FRAME_HEIGHT, self.decode_size[1])
+            cap.set(cv.CAP_PROP_FPS, self.decode_fps or 30)
+            cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*'MJPG'))
+        elif self.mode == 'file':
+            self.logger.info('INFO', 'Opening file {}'.format(source))
+            input_stream = build_file_pipeline(source, self.decode_size, self.decode_fps, realtime=not self.replay)
+            cap = cv.VideoCapture(input_stream, cv.CAP_GSTREAMER)
         else:
-            for stream_path in sources:
-                self.logger.info('INFO', 'Opening file {}'.format(stream_path))
-                input_stream = "souphttpsrc location=" + stream_path + " ! hlsdemux ! decodebin ! videoconvert ! videoscale ! appsink max-buffers=1 drop=true"
-                cap = cv.VideoCapture(input_stream, cv.CAP_GSTREAMER)
-                assert cap.isOpened()
-                self.captures.append(cap)
+            self.logger.info('INFO', 'Opening file {}'.format(source))
+            input_stream = build_hls_pipeline(source, self.decode_size, self.decode_fps)
+            cap = cv.VideoCapture(input_stream, cv.CAP_GSTREAMER)
+        return cap
+
+    @staticmethod
+    def _recording_start(capture, path):
+        """Estimates when a recording started from its modification time and duration"""
+        fps = capture.get(cv.CAP_PROP_FPS)
+        num_frames = capture.get(cv.CAP_PROP_FRAME_COUNT)
+        duration = num_frames / fps if fps > 0 and num_frames > 0 else 0
+        return os.path.getmtime(path) - duration
 
     def get_frames(self):
+        if self.readers:
+            if self.sync_tolerance > 0:
+                return self._get_synced_frames()
+            return self._get_latest_frames()
+
         frames = []
-        for capture in self.captures:
+        timestamps = []
+        for capture, clock in zip(self.captures, self.clocks):
             has_frame, frame = capture.read()
             if has_frame:
                 frames.append(frame)
+                timestamps.append(clock.timestamp(capture))
 
+        self.timestamps = timestamps
         return len(frames) == len(self.captures), frames
 
+    def get_timestamps(self):
+        """Returns the timestamps (ms) of the frame set returned by the last get_frames call"""
+        return self.timestamps
+
+    def read_into(self, buffers):
+        """Decodes the next frame of every capture straight into the given preallocated arrays"""
+        timestamps = []
+        for capture, clock, buffer in zip(self.captures, self.clocks, buffers):
+            has_frame, frame = capture.read(buffer)
+            if not has_frame:
+                return False
+            if frame.ctypes.data != buffer.ctypes.data:
+                # the stream changed its resolution, fit the frame into the preallocated buffer
+                cv.resize(frame, (buffer.shape[1], buffer.shape[0]), dst=buffer)
+            timestamps.append(clock.timestamp(capture))
+        self.timestamps = timestamps
+        return True
+
+    def _active_readers(self):
+        """Returns the readers expected to deliver frames, or None if some of them has no fresh frame yet"""
+        active = [reader for reader in self.readers if not reader.is_missing(self.stale_timeout)]
+        if not active or not all(reader.has_frame() for reader in active):
+            return None
+        return active
+
+    def _get_latest_frames(self):
+        """Assembles a frame set from the newest frame of every reader without blocking"""
+        active = self._active_readers()
+        if active is None:
+            return False, []
+        items = [reader.get_latest() if reader in active else None for reader in self.readers]
+        self.timestamps = [item[0] if item is not None else None for item in items]
+        return True, [item[1] if item is not None else None for item in items]
+
+    def _get_synced_frames(self):
+        """Assembles a frame set whose timestamps all lie within sync_tolerance of each other
+
+        The reference instant is the newest frame of the most delayed camera. Frames that
+        can no longer be part of any set are dropped, and the readers skip decoding them.
+        """
+        active = self._active_readers()
+        if active is None:
+            return False, []
+        rings = [reader.snapshot() for reader in active]
+        if not all(rings):
+            return False, []
+
+        newest = [ring[-1][0] for ring in rings]
+        reference = min(newest)
+        self.watermark = reference - self.sync_tolerance
+        for reader in active:
+            reader.drop_until(self.watermark)
+
+        chosen = {}
+        for reader, ring in zip(active, rings):
+            timestamp, frame = min(ring, key=lambda item: abs(item[0] - reference))
+            if abs(timestamp - reference) > self.sync_tolerance:
+                # another camera is already past the reference instant, it will never be matched
+                for laggard, last in zip(active, newest):
+                    if last == reference:
+                        laggard.drop_until(reference)
+                return False, []
+            chosen[reader] = (timestamp, frame)
+
+        for reader, (timestamp, _) in chosen.items():
+            reader.drop_until(timestamp)
+        items = [chosen.get(reader) for reader in self.readers]
+        self.timestamps = [item[0] if item is not None else None for item in items]
+        return True, [item[1] if item is not None else None for item in items]
+
+    def get_skipped(self):
+        """Returns how many late frames the readers grabbed without decoding them"""
+        return sum(reader.skipped for reader in self.readers)
+
+    def is_running(self):
+        """Returns True while frames can still arrive without calling get_frames (threaded mode)"""
+        return bool(self.readers) and all(reader.running for reader in self.readers)
+
+    def release(self):
+        self.supervising = False
+        for reader in self.readers:
+            reader.stop()
+        # readers replace their capture when reconnecting
+        captures = [reader.capture for reader in self.readers] if self.readers else self.captures
+        for capture in captures:
+            if capture is not None:
+                capture.release()
+
     def get_num_sources(self):
-        return len(self.captures)
\ No newline at end of file
+        return len(self.captures)
@@ -37,8 +37,13 @@ def draw_detections(frame, detections):
 def visualize_multicam_detections(frames, all_objects, fps=''):
     assert len(frames) == len(all_objects)
     vis = None
+    shape = next(frame.shape for frame in frames if frame is not None)
     for frame, objects in zip(frames, all_objects):
-        draw_detections(frame, objects)
+        if frame is None:
+            # camera missing from the frame set
+            frame = np.zeros(shape, dtype=np.uint8)
+        else:
+            draw_detections(frame, objects)
         if vis is not None:
             vis = np.vstack([vis, frame])
         else: